@@ -0,0 +1,302 @@
+'''Microbenchmarks for the pipeline's hot paths.
+
+Run from the repository root:
+
+    python -m benchmark [--quick] [--output PATH] [--baseline PATH]
+                        [--save-baseline] [--threshold 0.2]
+
+Results are written as JSON. If a baseline file exists, every benchmark is
+compared against it and the run exits non-zero when any of them is slower,
+or uses more memory, than the baseline by more than the threshold.
+Baselines are specific to a machine; record one with --save-baseline before
+comparing.
+'''
+from shutil import which
+from workflow.monitor import FilePatternMonitor
+import workflow.scipion as scipion
+import workflow.utilities as util
+import workflow.workflow as wf
+import argparse
+import asyncio
+import gc
+import json
+import os
+import pathlib
+import platform
+import sys
+import tempfile
+import time
+
+BENCHMARK_ROOT = pathlib.Path(__file__).resolve().parent
+REPO_ROOT = BENCHMARK_ROOT.parent
+MRC_HEADER_SIZE = 1024
+
+
+def _best_of(func, repeat):
+    '''Return the fastest of `repeat` runs of func, in seconds.
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _touch_files(directory, count):
+    for i in range(count):
+        open(os.path.join(directory, 'movie_{0:06d}.mrc'.format(i)),
+             'wb').close()
+
+
+def _write_synthetic_mrc(path, size):
+    '''Write an MRC-like file: a zero header and low-entropy 16-bit pixels.
+    '''
+    block = bytes((i * 7) % 13 for i in range(1024 * 1024))
+    with open(str(path), 'wb') as f:
+        f.write(bytes(MRC_HEADER_SIZE))
+        written = MRC_HEADER_SIZE
+        while written < size:
+            f.write(block[:size - written])
+            written += len(block)
+
+
+class _StubProject():
+    '''Enough of a Project for WorkflowItem construction.
+    '''
+
+    def __init__(self):
+        self.project = 'benchmark'
+        self.awh = wf.AsyncWorkflowHelper()
+        self.paths = {'local_root': tempfile.gettempdir()}
+        self.path_table = wf.PathTable()
+
+
+class _QuietItem(wf.WorkflowItem):
+    '''A WorkflowItem whose callbacks do nothing, to time transitions on the
+    slotted items' shared trigger path on their own.
+    '''
+    __slots__ = ()
+
+    def on_enter_creating(self):
+        pass
+
+
+def _rss():
+    '''Resident set size of this process in bytes.
+    '''
+    with open('/proc/self/statm', mode='r') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def bench_memory(results, count):
+    '''RSS growth per 100k items carrying a typical item's paths.
+
+    Run before anything else, so memory freed by earlier benchmarks cannot
+    absorb the growth.
+    '''
+    if not os.path.exists('/proc/self/statm'):
+        print('/proc not available, skipping memory', file=sys.stderr)
+        return
+    project = _StubProject()
+    workflow = wf.Workflow()
+    items = []
+    gc.collect()
+    before = _rss()
+    for i in range(count):
+        name = 'movie_{0:06d}_{1:02d}.tif'.format(i // 40, i % 40)
+        item = wf.WorkflowItem('/camera/session/' + name, workflow, project)
+        workflow.add_model(item)
+        item.files['local_original'] = pathlib.Path('/scratch/benchmark',
+                                                    name)
+        item.files['local_stack'] = item.files['local_original']
+        item.files['local_compressed'] = pathlib.Path('/scratch/benchmark',
+                                                      name + '.bz2')
+        item.files['storage_final'] = pathlib.Path('/mnt/nas/benchmark',
+                                                   name + '.bz2')
+        items.append(item)
+    gc.collect()
+    results['memory_rss_per_100k_items'] = {
+        'bytes': (_rss() - before) * 100000 / count, 'n': count}
+
+
+def bench_monitor(results, loop, sizes, repeat):
+    for count in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            _touch_files(directory, count)
+            pattern = os.path.join(directory, '*.mrc')
+
+            def first_poll():
+                loop.run_until_complete(
+                    FilePatternMonitor(pattern)._get_new_files())
+            monitor = FilePatternMonitor(pattern)
+            loop.run_until_complete(monitor._get_new_files())
+
+            def steady_poll():
+                loop.run_until_complete(monitor._get_new_files())
+            results['monitor_first_poll_{0}'.format(count)] = {
+                'seconds': _best_of(first_poll, repeat), 'n': count}
+            results['monitor_steady_poll_{0}'.format(count)] = {
+                'seconds': _best_of(steady_poll, repeat), 'n': count}
+
+
+def bench_models(results, sizes, repeat):
+    project = _StubProject()
+    for count in sizes:
+        workflow = wf.Workflow()
+        items = [wf.WorkflowItem('/bench/{0}'.format(i), workflow, project)
+                 for i in range(count)]
+        start = time.perf_counter()
+        for item in items:
+            workflow.add_model(item)
+        results['workflow_add_model_{0}'.format(count)] = {
+            'seconds': (time.perf_counter() - start) / count, 'n': count,
+            'per': 'model'}
+        key = items[-1].files['original']
+        results['workflow_get_model_{0}'.format(count)] = {
+            'seconds': _best_of(lambda: workflow.get_model(key), repeat),
+            'n': count}
+
+
+def bench_transitions(results, count, repeat):
+    project = _StubProject()
+    workflow = wf.Workflow()
+    models = [_QuietItem('/bench/{0}'.format(i), workflow, project)
+              for i in range(count)]
+    workflow.add_model(models)
+
+    def cycle():
+        for model in models:
+            workflow.set_state('initial', model=model)
+            model.initialize()
+    results['transition_per_state_change'] = {
+        'seconds': _best_of(cycle, repeat) / count, 'n': count,
+        'per': 'transition'}
+
+
+def bench_files(results, loop, size, repeat):
+    with tempfile.TemporaryDirectory() as directory:
+        path_a = pathlib.Path(directory, 'a.mrc')
+        path_b = pathlib.Path(directory, 'b.mrc')
+        _write_synthetic_mrc(path_a, size)
+        _write_synthetic_mrc(path_b, size)
+        seconds = _best_of(lambda: loop.run_until_complete(
+            util.compare_hashes(path_a, path_b)), repeat)
+        results['compare_hashes'] = {
+            'seconds': seconds, 'n': size, 'per': 'pair',
+            'bytes_per_second': 2 * size / seconds}
+        if which('lbzip2') is None:
+            print('lbzip2 not found, skipping compress_file', file=sys.stderr)
+            return
+        seconds = _best_of(lambda: loop.run_until_complete(
+            util.compress_file(path_a, force=True)), repeat)
+        results['compress_file'] = {
+            'seconds': seconds, 'n': size,
+            'bytes_per_second': size / seconds}
+
+
+def bench_config(results, repeat):
+    with tempfile.TemporaryDirectory() as directory:
+        gainref = pathlib.Path(directory, 'gain.mrc')
+        movie = pathlib.Path(directory, 'movie.mrc')
+        gainref.touch()
+        movie.touch()
+        output = pathlib.Path(directory, 'scipion.json')
+        scipion.APPLICATION_PATH = str(REPO_ROOT)
+
+        def generate():
+            if output.exists():
+                output.unlink()
+            scipion.Config(
+                project='benchmark', src_pattern=str(movie),
+                working_directory=directory, path_to_gainref=str(gainref),
+                frames=1, physical_pixel=5, image_pixel=1.0,
+                super_resolution=True, ctf_low_res=30, ctf_high_res=3,
+                defocus_min=0.25, defocus_max=5,
+                scipion_output=str(output)).generate_config()
+        results['config_generate'] = {'seconds': _best_of(generate, repeat)}
+
+
+def compare(results, baseline, threshold):
+    '''Print a comparison table, return the names that regressed.
+    '''
+    regressions = []
+    for name in sorted(results):
+        unit = 'seconds' if 'seconds' in results[name] else 'bytes'
+        now = results[name][unit]
+        before = baseline.get(name, {}).get(unit)
+        shown = ('{0:12.6f} s'.format(now) if unit == 'seconds' else
+                 '{0:10.1f} MiB'.format(now / 1024 / 1024))
+        if before:
+            change = now / before - 1
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions.append(name)
+            print('{0:36s} {1}  {2:+7.1%}{3}'.format(
+                name, shown, change, flag))
+        else:
+            print('{0:36s} {1}  (no baseline)'.format(name, shown))
+    return regressions
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(prog='python -m benchmark')
+    parser.add_argument('--quick', action='store_true',
+                        help='Smaller sizes for a fast smoke run.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per benchmark; the fastest is kept.')
+    parser.add_argument('--output', type=str,
+                        default=str(BENCHMARK_ROOT / 'results.json'),
+                        help='Where to write the JSON results.')
+    parser.add_argument('--baseline', type=str,
+                        default=str(BENCHMARK_ROOT / 'baseline.json'),
+                        help='Baseline JSON results to compare against.')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Also write the results to the baseline path.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed slowdown before a regression is\
+                        reported, as a fraction. Defaults to 0.2.')
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_arguments()
+    loop = asyncio.get_event_loop()
+    monitor_sizes = [1000, 10000] if args.quick else [1000, 10000, 100000]
+    model_sizes = [100, 1000] if args.quick else [1000, 10000]
+    file_size = (16 if args.quick else 256) * 1024 * 1024
+    results = {}
+    bench_memory(results, 10000 if args.quick else 100000)
+    bench_monitor(results, loop, monitor_sizes, args.repeat)
+    bench_models(results, model_sizes, args.repeat)
+    bench_transitions(results, model_sizes[-1], args.repeat)
+    bench_files(results, loop, file_size, args.repeat)
+    bench_config(results, args.repeat)
+    report = {
+        'meta': {'python': platform.python_version(),
+                 'platform': platform.platform(),
+                 'time': time.time(),
+                 'quick': args.quick},
+        'results': results,
+    }
+    with open(args.output, mode='w', encoding='utf8') as f:
+        f.write(json.dumps(report, sort_keys=True, indent=4))
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, mode='r', encoding='utf8') as f:
+            stored = json.loads(f.read())
+        baseline = stored['results']
+        if stored['meta'].get('quick') != args.quick:
+            print('Baseline was recorded with a different --quick setting',
+                  file=sys.stderr)
+    regressions = compare(results, baseline, args.threshold)
+    if args.save_baseline:
+        with open(args.baseline, mode='w', encoding='utf8') as f:
+            f.write(json.dumps(report, sort_keys=True, indent=4))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
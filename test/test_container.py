@@ -0,0 +1,104 @@
+import workflow.container as container
+import workflow.utilities as util
+import asyncio
+import os
+import pathlib
+import tempfile
+import unittest
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ContainerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.directory.name)
+        self.members = []
+        contents = {
+            'text.mrc': bytes(i % 7 for i in range(3 * CHUNK_SIZE + 123)),
+            'random.eer': os.urandom(CHUNK_SIZE + 5),
+            'empty.mrc': b''}
+        for name, data in contents.items():
+            path = self.root.joinpath(name)
+            path.write_bytes(data)
+            self.members.append((name, path))
+        self.contents = contents
+        self.pak = self.root.joinpath('test.pak')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def pack(self):
+        return self.loop.run_until_complete(container.pack_files(
+            self.members, self.pak, chunk_size=CHUNK_SIZE, window=2))
+
+    def test_members_round_trip(self):
+        self.pack()
+        with container.ContainerReader(self.pak) as reader:
+            self.assertEqual(reader.names(), [n for n, _ in self.members])
+            for name, data in self.contents.items():
+                self.assertEqual(reader.read(name), data)
+
+    def test_single_chunk_is_read_on_its_own(self):
+        self.pack()
+        with container.ContainerReader(self.pak) as reader:
+            self.assertEqual(reader.read_chunk('text.mrc', 2),
+                             self.contents['text.mrc'][2 * CHUNK_SIZE:
+                                                       3 * CHUNK_SIZE])
+
+    def test_incompressible_chunks_are_stored_raw(self):
+        index = {m['name']: m for m in self.pack()}
+        self.assertEqual({c[2] for c in index['random.eer']['chunks']},
+                         {container.CODEC_RAW})
+        self.assertEqual({c[2] for c in index['text.mrc']['chunks']},
+                         {container.CODEC_ZLIB})
+
+    def test_digests_match_tree_hash(self):
+        for member in self.pack():
+            path = self.root.joinpath(member['name'])
+            self.assertEqual(
+                member['digest'],
+                self.loop.run_until_complete(
+                    util.tree_hash(path, chunk_size=CHUNK_SIZE)))
+
+    def test_extract_restores_contents_and_mtime(self):
+        os.utime(str(self.members[0][1]), (1000000000, 1000000000))
+        self.pack()
+        dest = self.root.joinpath('extracted')
+        with container.ContainerReader(self.pak) as reader:
+            reader.extract('text.mrc', dest)
+        self.assertEqual(dest.read_bytes(), self.contents['text.mrc'])
+        self.assertEqual(os.stat(str(dest)).st_mtime, 1000000000)
+
+    def test_verify_passes_on_good_container(self):
+        digests = {m['name']: m['digest'] for m in self.pack()}
+        self.assertEqual(self.loop.run_until_complete(
+            container.verify_container(self.pak, digests)), [])
+
+    def test_verify_reports_corrupt_and_missing_members(self):
+        index = self.pack()
+        digests = {m['name']: m['digest'] for m in index}
+        digests['absent.mrc'] = digests['empty.mrc']
+        offset = index[1]['chunks'][0][0]
+        with open(str(self.pak), 'r+b') as f:
+            f.seek(offset + 10)
+            f.write(b'\0\0\0\0')
+        self.assertEqual(self.loop.run_until_complete(
+            container.verify_container(self.pak, digests)),
+            ['random.eer', 'absent.mrc'])
+
+    def test_reader_rejects_other_files(self):
+        with self.assertRaises(ValueError):
+            container.ContainerReader(self.members[0][1])
+
+    def test_failed_pack_removes_partial(self):
+        self.members.append(('gone.mrc', self.root.joinpath('gone.mrc')))
+        with self.assertRaises(FileNotFoundError):
+            self.pack()
+        self.assertFalse(self.pak.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
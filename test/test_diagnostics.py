@@ -0,0 +1,79 @@
+import workflow.diagnostics as diag
+import workflow.workflow as wf
+import unittest
+import asyncio
+import io
+import os
+import pathlib
+import tempfile
+import time
+
+
+class DiagnosticsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def tearDown(self):
+        pass
+
+    def test_callback_profiler_counts_calls(self):
+        class Model():
+            def on_enter_state(self):
+                return 'entered'
+        profiler = diag.CallbackProfiler()
+        profiler.install(Model)
+        self.assertEqual(Model().on_enter_state(), 'entered')
+        self.assertEqual(profiler.calls['on_enter_state'], 1)
+        out = io.StringIO()
+        profiler.report(out)
+        self.assertIn('on_enter_state', out.getvalue())
+
+    def test_callback_profiler_times_subclass_overrides(self):
+        class Model():
+            def on_enter_state(self):
+                return 'entered'
+
+            def on_enter_other(self):
+                return 'other'
+
+        class Subclass(Model):
+            def on_enter_state(self):
+                return super().on_enter_state()
+        profiler = diag.CallbackProfiler()
+        profiler.install(Model, Subclass)
+        item = Subclass()
+        self.assertEqual(item.on_enter_state(), 'entered')
+        self.assertEqual(item.on_enter_other(), 'other')
+        self.assertEqual(profiler.calls['Subclass.on_enter_state'], 1)
+        self.assertEqual(profiler.calls['on_enter_state'], 1)
+        self.assertEqual(profiler.calls['on_enter_other'], 1)
+
+    def test_dump_tasks_names_owner(self):
+        awh = wf.AsyncWorkflowHelper()
+
+        class Owner():
+            files = {'original': pathlib.Path('/data/movie.mrc')}
+            state = 'importing'
+
+            def done(self, fut):
+                pass
+        owner = Owner()
+        awh.create_task(asyncio.sleep(10), owner.done)
+        out = io.StringIO()
+        diag.dump_tasks(awh, out)
+        self.assertIn('/data/movie.mrc state=importing', out.getvalue())
+        for task in list(awh.owners.keys()):
+            task.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_sampling_profiler_writes_collapsed_stacks(self):
+        profiler = diag.SamplingProfiler(interval=0.001)
+        profiler.start()
+        time.sleep(0.05)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'out.collapsed')
+            profiler.stop(path)
+            with open(path) as f:
+                lines = f.read()
+        self.assertRegex(lines, r'(?m)^MainThread;.* \d+$')
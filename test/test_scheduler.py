@@ -0,0 +1,68 @@
+import workflow.scheduler as sched
+import unittest
+import asyncio
+
+
+class StageSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.order = []
+
+    def tearDown(self):
+        pass
+
+    async def record(self, name):
+        self.order.append(name)
+
+    def run_queued(self, scheduler):
+        async def drain():
+            while scheduler.running or scheduler.depth():
+                await asyncio.sleep(0)
+        self.loop.run_until_complete(drain())
+
+    def test_high_priority_runs_lowest_key_first(self):
+        scheduler = sched.StageScheduler(self.loop, slots=1)
+        scheduler.running = 1
+        scheduler.submit(self.record('old'), priority=sched.HIGH, key=-1)
+        scheduler.submit(self.record('new'), priority=sched.HIGH, key=-2)
+        scheduler._task_done(None)
+        self.run_queued(scheduler)
+        self.assertEqual(self.order, ['new', 'old'])
+
+    def test_low_priority_gets_minimum_share(self):
+        scheduler = sched.StageScheduler(self.loop, slots=1, low_share=0.25)
+        scheduler.running = 1
+        for i in range(6):
+            scheduler.submit(self.record('high'), priority=sched.HIGH, key=i)
+        scheduler.submit(self.record('low'), priority=sched.LOW)
+        scheduler._task_done(None)
+        self.run_queued(scheduler)
+        self.assertEqual(self.order.index('low'), 3)
+
+    def test_slots_limit_running_tasks(self):
+        scheduler = sched.StageScheduler(self.loop, slots=2)
+        for i in range(5):
+            scheduler.submit(asyncio.sleep(0))
+        self.assertEqual(scheduler.running, 2)
+        self.assertEqual(scheduler.depth(), 3)
+        self.run_queued(scheduler)
+
+    def test_high_priority_starts_while_low_fills_its_slots(self):
+        scheduler = sched.StageScheduler(self.loop, slots=3, high_reserved=1)
+        blocked = self.loop.create_future()
+        for i in range(4):
+            scheduler.submit(asyncio.wait_for(blocked, None),
+                             priority=sched.LOW, key=i)
+        self.assertEqual(scheduler.running, 2)
+        scheduler.submit(self.record('high'), priority=sched.HIGH)
+        self.assertEqual(scheduler.running, 3)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.order, ['high'])
+        self.assertEqual(scheduler.depth(sched.LOW), 2)
+        blocked.set_result(None)
+        self.run_queued(scheduler)
+
+    def test_invalid_low_share_raises_ValueError(self):
+        with self.assertRaises(ValueError):
+            sched.StageScheduler(self.loop, low_share=0)
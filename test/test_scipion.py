@@ -0,0 +1,41 @@
+import workflow.scipion as scipion
+import unittest
+
+
+class ConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = scipion.Config(
+            project='test', src_pattern='/data/*.tif',
+            working_directory='/work', frames=1, physical_pixel=5,
+            image_pixel=1, super_resolution=False, ctf_low_res=30,
+            ctf_high_res=3, defocus_min=0.25, defocus_max=4)
+
+    def tearDown(self):
+        pass
+
+    def files_pattern(self):
+        template = [{}, {}, {}]
+        scipion.Config._template_insert_values(template, self.config)
+        return template[0]['filesPattern']
+
+    def test_input_suffix_keeps_direct_formats(self):
+        for pattern in ('*.tif', '*.eer', '*.mrc', '*.TIFF'):
+            self.assertEqual(scipion.Config._input_suffix(pattern),
+                             pattern[1:])
+
+    def test_input_suffix_imports_converted_formats_as_mrc(self):
+        self.assertEqual(scipion.Config._input_suffix('*.dm4'), '.mrc')
+
+    def test_files_pattern_follows_source_suffix(self):
+        self.assertEqual(self.files_pattern(), '*.tif')
+        self.config.source_pattern = '/data/*.dm4'
+        self.assertEqual(self.files_pattern(), '*.mrc')
+
+    def test_files_pattern_uses_stacks_in_frames_mode(self):
+        self.config.frames_to_stack = 4
+        self.assertEqual(self.files_pattern(), 'stack/*.mrc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import workflow.scratch as scratch
+import os
+import tempfile
+import unittest
+
+
+class ScratchVolumesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.volumes = scratch.ScratchVolumes(['/scratch/a', '/scratch/b'])
+        self.a, self.b = self.volumes.volumes
+
+    def tearDown(self):
+        pass
+
+    def test_select_spreads_reservations(self):
+        first = self.volumes.select(100)
+        second = self.volumes.select(100)
+        self.assertIsNot(first, second)
+        self.assertEqual(first.in_flight, 100)
+        self.assertEqual(self.volumes.in_flight, 200)
+
+    def test_select_prefers_faster_volume(self):
+        self.a.rate = 100
+        self.b.rate = 400
+        self.b.in_flight = 250
+        self.assertIs(self.volumes.select(100), self.b)
+        self.assertIs(self.volumes.select(100), self.a)
+
+    def test_release_returns_reservation(self):
+        volume = self.volumes.select(100)
+        self.volumes.release(volume, 60)
+        self.assertEqual(volume.in_flight, 40)
+        self.volumes.release(volume, 60)
+        self.assertEqual(volume.in_flight, 0)
+
+    def test_record_moves_rate_towards_sample(self):
+        self.a.rate = 100
+        self.volumes.record(self.a, 400, 1)
+        self.assertAlmostEqual(self.a.rate, 0.7 * 100 + 0.3 * 400)
+        self.volumes.record(self.a, 0, 1)
+        self.volumes.record(self.a, 400, 0)
+        self.assertAlmostEqual(self.a.rate, 190)
+
+    def test_sample_uses_device_busy_time(self):
+        self.a.device = (8, 1)
+        self.b.device = (8, 2)
+        self.a.rate = 100
+        line = '8 {0} sda{0} 0 0 {1} 0 0 0 {2} 0 0 {3} 0\n'
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'diskstats')
+            with open(path, 'w') as f:
+                f.write(line.format(1, 0, 0, 0) + line.format(2, 0, 0, 0))
+            self.volumes.sample(path)
+            self.assertEqual(self.a.rate, 100)
+            with open(path, 'w') as f:
+                f.write(line.format(1, 2, 2, 2000) + line.format(2, 0, 0, 0))
+            self.volumes.sample(path)
+        self.assertAlmostEqual(self.a.rate, 0.7 * 100 + 0.3 * 1024)
+        self.assertEqual(self.b.rate, scratch.DEFAULT_RATE)
+
+    def test_sample_resolves_volume_device(self):
+        with tempfile.TemporaryDirectory() as d:
+            volumes = scratch.ScratchVolumes([d])
+            volumes.sample(os.path.join(d, 'missing'))
+            volumes.sample()
+            dev = os.stat(d).st_dev
+            self.assertEqual(volumes.volumes[0].device,
+                             (os.major(dev), os.minor(dev)))
+
+
+if __name__ == '__main__':
+    unittest.main()
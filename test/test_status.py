@@ -0,0 +1,115 @@
+import workflow.status as status
+import workflow.scheduler as sched
+import workflow.throttle as throttle
+import unittest
+import asyncio
+import json
+import os
+import tempfile
+import time
+import types
+
+
+class StatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        model = types.SimpleNamespace(state='importing')
+        self.project = types.SimpleNamespace(
+            project='test',
+            workflow=types.SimpleNamespace(models=[None, model, model]),
+            awh=types.SimpleNamespace(
+                scheduler=sched.StageScheduler(self.loop)),
+            stats=status.PipelineStats(),
+            paths={'local_root': self.tmpdir.name},
+            monitor=types.SimpleNamespace(base_time=time.time()),
+            globus_status={'last_submit': None, 'task_id': 'abc',
+                           'status': 'ACTIVE'})
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_throughput_only_counts_window(self):
+        stats = status.PipelineStats()
+        now = time.time()
+        stats.record(100, now=now - 600)
+        stats.record(300, now=now - 10)
+        items, nbytes = stats.throughput(300, now=now)
+        self.assertEqual(items, 1 / 300)
+        self.assertEqual(nbytes, 1)
+
+    def test_snapshot_counts_states(self):
+        server = status.StatusServer(self.project, '0')
+        self.assertEqual(server.snapshot()['states'], {'importing': 2})
+
+    def test_prometheus_format_has_state_label(self):
+        server = status.StatusServer(self.project, '0')
+        text = server.format_prometheus(server.snapshot())
+        self.assertIn('cryoem_pipeline_items{state="importing"} 2.0', text)
+
+    def test_prometheus_format_has_globus_task_status(self):
+        server = status.StatusServer(self.project, '0')
+        text = server.format_prometheus(server.snapshot())
+        self.assertIn(
+            'cryoem_pipeline_globus_task_status{status="ACTIVE"} 1.0', text)
+
+    def test_prometheus_format_has_bandwidth_limits(self):
+        bucket = throttle.get_limiter().set_limit(self.tmpdir.name, 1024)
+        server = status.StatusServer(self.project, '0')
+        text = server.format_prometheus(server.snapshot())
+        throttle.get_limiter().set_limit(self.tmpdir.name, None)
+        self.assertIn('cryoem_pipeline_bandwidth_limit_bytes_per_second'
+                      '{{mount="{0}"}} 1024.0'.format(bucket.name), text)
+
+    def test_prometheus_format_escapes_label_values(self):
+        self.project.globus_status['status'] = 'a\\b "c"\nd'
+        server = status.StatusServer(self.project, '0')
+        text = server.format_prometheus(server.snapshot())
+        self.assertIn('{status="a\\\\b \\"c\\"\\nd"} 1.0', text)
+
+    def test_relative_path_is_unix_socket(self):
+        server = status.StatusServer(self.project, 'status.sock')
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        try:
+            self.loop.run_until_complete(server.start())
+            server.close()
+            self.assertTrue(os.path.exists('status.sock'))
+        finally:
+            os.chdir(cwd)
+
+    def test_unix_socket_serves_json(self):
+        path = os.path.join(self.tmpdir.name, 'status.sock')
+        server = status.StatusServer(self.project, path)
+
+        async def fetch():
+            await server.start()
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(b'GET /status HTTP/1.0\r\n\r\n')
+            response = await reader.read()
+            writer.close()
+            server.close()
+            return response
+        response = self.loop.run_until_complete(fetch())
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.0 200 OK'))
+        self.assertEqual(json.loads(body.decode())['project'], 'test')
+
+    def test_backlog_eta_from_finished_rate(self):
+        models = [types.SimpleNamespace(state='finished'),
+                  types.SimpleNamespace(state='importing')]
+        backlog = status.BacklogProgress(models, start=100)
+        snap = backlog.snapshot(now=110)
+        self.assertEqual(snap['done'], 1)
+        self.assertEqual(snap['eta_seconds'], 10)
+        self.assertFalse(backlog.complete)
+
+    def test_backlog_incomplete_until_every_file_admitted(self):
+        backlog = status.BacklogProgress([], start=100, total=2)
+        backlog.add(types.SimpleNamespace(state='finished'))
+        self.assertEqual(backlog.snapshot(now=110)['total'], 2)
+        self.assertEqual(backlog.in_flight, 0)
+        self.assertFalse(backlog.complete)
+        backlog.add(types.SimpleNamespace(state='finished'))
+        self.assertTrue(backlog.complete)
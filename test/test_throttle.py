@@ -0,0 +1,87 @@
+import workflow.throttle as throttle
+import workflow.utilities as util
+import asyncio
+import os
+import pathlib
+import tempfile
+import time
+import unittest
+
+
+class ThrottleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.directory.name)
+        throttle._limiter = None
+
+    def tearDown(self):
+        throttle._limiter = None
+        self.directory.cleanup()
+
+    def test_parse_rate_units(self):
+        self.assertEqual(throttle.parse_rate('200M'), 200 * 1024 ** 2)
+        self.assertEqual(throttle.parse_rate('1.5GiB'), 1.5 * 1024 ** 3)
+        self.assertEqual(throttle.parse_rate('4096'), 4096)
+        self.assertIsNone(throttle.parse_rate('off'))
+        self.assertIsNone(throttle.parse_rate('0'))
+        with self.assertRaises(ValueError):
+            throttle.parse_rate('fast')
+
+    def test_bucket_queues_concurrent_callers(self):
+        bucket = throttle.TokenBucket('test', rate=100)
+        first = bucket.reserve(50)
+        second = bucket.reserve(50)
+        self.assertAlmostEqual(first, 0.5, places=2)
+        self.assertAlmostEqual(second, 1.0, places=2)
+        self.assertEqual(bucket.bytes, 100)
+
+    def test_unlimited_bucket_counts_without_waiting(self):
+        bucket = throttle.TokenBucket('test')
+        self.assertEqual(bucket.reserve(10 ** 12), 0)
+        self.assertEqual(bucket.bytes, 10 ** 12)
+
+    def test_files_on_a_mount_share_its_bucket(self):
+        limiter = throttle.BandwidthLimiter()
+        limiter.set_limit(self.root, 1000)
+        bucket = limiter.bucket(self.root.joinpath('not', 'yet', 'made'))
+        self.assertEqual(bucket.name, throttle.mount_point(self.root))
+        self.assertEqual(bucket.rate, 1000)
+
+    def test_load_applies_and_clears_limits(self):
+        limiter = throttle.BandwidthLimiter()
+        limits = self.root.joinpath('limits')
+        limits.write_text('# storage\n{0} 10M\nbad line here\n'.format(
+            self.root))
+        limiter.load(limits)
+        self.assertEqual(limiter.bucket(self.root).rate, 10 * 1024 ** 2)
+        limits.write_text('\n')
+        limiter.load(limits)
+        self.assertIsNone(limiter.bucket(self.root).rate)
+
+    def test_limited_copy_is_held_to_rate(self):
+        src = self.root.joinpath('src')
+        src.write_bytes(os.urandom(1024 * 1024))
+        throttle.get_limiter().set_limit(self.root, 4 * 1024 * 1024)
+        start = time.monotonic()
+        self.loop.run_until_complete(util.parallel_copy_file(
+            src, self.root.joinpath('dest')))
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(self.root.joinpath('dest').read_bytes(),
+                         src.read_bytes())
+
+    def test_limited_copy_file_range_is_held_to_rate(self):
+        src = self.root.joinpath('src')
+        dest = self.root.joinpath('dest')
+        src.write_bytes(os.urandom(1024 * 1024))
+        throttle.get_limiter().set_limit(self.root, 4 * 1024 * 1024)
+        start = time.monotonic()
+        self.loop.run_until_complete(util._copy_file_range(
+            str(src), str(dest)))
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(dest.read_bytes(), src.read_bytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
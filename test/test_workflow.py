@@ -1,8 +1,15 @@
 import workflow.utilities as util
+import workflow.workflow as wf
+from workflow.scratch import ScratchVolumes
+from workflow.status import PipelineStats
 import asyncio
+import os
 import pathlib
 import unittest
 import tempfile
+import time
+import types
+from unittest import mock
 
 named_temp = tempfile.NamedTemporaryFile
 
@@ -11,31 +18,12 @@ class UtilitiesTests(unittest.TestCase):
 
     fake_path = '/path/to/a/fake/file'
 
-    def future_has_stderr_content(self, fut):
-        self.assertTrue(fut.result()[1])
-
-    def future_has_no_stderr_content(self, fut):
-        self.assertFalse(fut.result()[1])
-
     def setUp(self):
         self.loop = asyncio.get_event_loop()
 
     def tearDown(self):
         pass
 
-    def test_hash_errors_on_fake_path(self):
-        func = util.file_hash(self.fake_path)
-        task = self.loop.create_task(func)
-        task.add_done_callback(self.future_has_stderr_content)
-        self.loop.run_until_complete(task)
-
-    def test_hash_succeeds_on_real_path(self):
-        with named_temp() as f:
-            func = util.file_hash(f.name)
-            task = self.loop.create_task(func)
-            task.add_done_callback(self.future_has_no_stderr_content)
-            self.loop.run_until_complete(task)
-
     def test_compare_hash_succeeds_on_identical_content(self):
         with named_temp() as f1, named_temp() as f2:
             func = util.compare_hashes(f1.name, f2.name)
@@ -54,6 +42,18 @@ class UtilitiesTests(unittest.TestCase):
                 lambda fut: self.assertFalse(fut.result()))
             self.loop.run_until_complete(task)
 
+    def test_compare_hash_writes_digest_file_on_match(self):
+        with named_temp() as f1, named_temp() as f2, \
+                tempfile.TemporaryDirectory() as d:
+            digest_file = os.path.join(d, 'archive' + util.DIGEST_SUFFIX)
+            self.assertTrue(self.loop.run_until_complete(
+                util.compare_hashes(f1.name, f2.name,
+                                    digest_file=digest_file)))
+            digest = self.loop.run_until_complete(util.tree_hash(f1.name))
+            with open(digest_file, encoding='utf8') as f:
+                self.assertEqual(f.read(), '{0}  {1}\n'.format(
+                    digest, os.path.basename(f1.name)))
+
     def test_compare_hash_raises_error_on_fake_path(self):
         with named_temp() as f1:
             func = util.compare_hashes(f1.name, self.fake_path)
@@ -61,6 +61,40 @@ class UtilitiesTests(unittest.TestCase):
             with self.assertRaises(FileNotFoundError):
                 self.loop.run_until_complete(task)
 
+    def test_tree_hash_reports_format_and_chunk_size(self):
+        with named_temp() as f:
+            digest = self.loop.run_until_complete(
+                util.tree_hash(f.name, chunk_size=util.HASH_BLOCK_SIZE))
+            algorithm, chunk_size, hexdigest = digest.split(':')
+            self.assertEqual(algorithm, 'blake2b-tree')
+            self.assertEqual(int(chunk_size), util.HASH_BLOCK_SIZE)
+            self.assertEqual(len(hexdigest), util.HASH_DIGEST_SIZE * 2)
+
+    def test_tree_hash_differs_on_late_chunk(self):
+        with named_temp() as f1, named_temp() as f2:
+            f1.write(b'a' * 100 + b'b')
+            f2.write(b'a' * 100 + b'c')
+            f1.flush()
+            f2.flush()
+            a = self.loop.run_until_complete(
+                util.tree_hash(f1.name, chunk_size=16))
+            b = self.loop.run_until_complete(
+                util.tree_hash(f2.name, chunk_size=16))
+            self.assertNotEqual(a, b)
+
+    def test_probe_separates_compressible_from_random(self):
+        with named_temp() as f1, named_temp() as f2:
+            f1.write(bytes(4096))
+            f2.write(os.urandom(4096))
+            f1.flush()
+            f2.flush()
+            low = self.loop.run_until_complete(
+                util.probe_compressibility(f1.name, blocks=2, block_size=512))
+            high = self.loop.run_until_complete(
+                util.probe_compressibility(f2.name, blocks=2, block_size=512))
+            self.assertLess(low, 0.1)
+            self.assertGreater(high, 0.9)
+
     def test_safe_copy_fails_when_dest_exists(self):
         with named_temp() as f1, named_temp() as f2:
             with self.assertRaises(FileExistsError):
@@ -76,3 +110,385 @@ class UtilitiesTests(unittest.TestCase):
                     util.safe_copy_file(f1.name, newpath))
             )
             self.assertTrue(pathlib.Path(newpath).exists())
+
+    def test_parallel_copy_matches_source(self):
+        content = os.urandom(1000)
+        with named_temp() as f1:
+            f1.write(content)
+            f1.flush()
+            newpath = f1.name+'testloc'
+            try:
+                ret = self.loop.run_until_complete(
+                    util.parallel_copy_file(f1.name, newpath, streams=2,
+                                            segment_size=64, min_size=0))
+                self.assertEqual(ret, 0)
+                with open(newpath, 'rb') as f2:
+                    self.assertEqual(f2.read(), content)
+            finally:
+                os.remove(newpath)
+
+    def test_parallel_copy_fails_when_dest_exists(self):
+        with named_temp() as f1, named_temp() as f2:
+            with self.assertRaises(FileExistsError):
+                self.loop.run_until_complete(
+                    util.parallel_copy_file(f1.name, f2.name, min_size=0))
+
+    def test_stage_file_same_device_avoids_copy(self):
+        content = os.urandom(1000)
+        with named_temp() as f1:
+            f1.write(content)
+            f1.flush()
+            newpath = f1.name+'testloc'
+            try:
+                method = self.loop.run_until_complete(
+                    util.stage_file(f1.name, newpath))
+                self.assertIn(method,
+                              ('reflink', 'hardlink', 'copy_file_range'))
+                with open(newpath, 'rb') as f2:
+                    self.assertEqual(f2.read(), content)
+            finally:
+                os.remove(newpath)
+
+    def test_tee_copy_writes_every_destination(self):
+        content = os.urandom(1000)
+        with named_temp() as f1, tempfile.TemporaryDirectory() as d:
+            f1.write(content)
+            f1.flush()
+            dests = [os.path.join(d, 'a'), os.path.join(d, 'b')]
+            results = self.loop.run_until_complete(
+                util.tee_copy_file(f1.name, dests, block_size=64,
+                                   queue_blocks=0))
+            self.assertEqual(results, {dest: None for dest in dests})
+            for dest in dests:
+                with open(dest, 'rb') as f2:
+                    self.assertEqual(f2.read(), content)
+            self.assertEqual(sorted(os.listdir(d)), ['a', 'b'])
+
+    def test_partial_path_is_hidden(self):
+        self.assertEqual(util.partial_path('/nas/p/a.mrc.bz2'),
+                         pathlib.Path('/nas/p/.a.mrc.bz2.part'))
+
+    def test_tee_copy_waits_for_single_slow_destination(self):
+        content = os.urandom(1000)
+        write = util._pwrite_all
+
+        def slow_write(fd, block, offset):
+            time.sleep(0.005)
+            write(fd, block, offset)
+        with named_temp() as f1, tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(util, '_pwrite_all', slow_write), \
+                mock.patch.object(util, '_pread_pwrite',
+                                  wraps=util._pread_pwrite) as catch_up:
+            dest = os.path.join(d, 'a')
+            f1.write(content)
+            f1.flush()
+            results = self.loop.run_until_complete(
+                util.tee_copy_file(f1.name, [dest], block_size=64,
+                                   queue_blocks=1))
+            self.assertEqual(results, {dest: None})
+            catch_up.assert_not_called()
+            with open(dest, 'rb') as f2:
+                self.assertEqual(f2.read(), content)
+
+    def test_tee_copy_reports_failed_destination(self):
+        with named_temp() as f1, named_temp() as f2:
+            results = self.loop.run_until_complete(
+                util.tee_copy_file(f1.name, [f2.name]))
+            self.assertIsInstance(results[f2.name], FileExistsError)
+
+
+class _SlottedModel():
+    __slots__ = ('workflow', 'state', 'files', 'entered')
+
+    def __init__(self, workflow, table, path):
+        self.workflow = workflow
+        self.files = wf.ItemFiles(table, original=path)
+        self.entered = []
+
+    def on_enter_creating(self):
+        self.entered.append('creating')
+
+
+class WorkflowModelTests(unittest.TestCase):
+
+    def setUp(self):
+        self.workflow = wf.Workflow()
+        self.table = wf.PathTable()
+
+    def test_slotted_models_share_triggers(self):
+        models = [_SlottedModel(self.workflow, self.table, '/cam/a.mrc'),
+                  _SlottedModel(self.workflow, self.table, '/cam/b.mrc')]
+        self.workflow.add_model(models)
+        models[0].initialize()
+        self.assertEqual(models[0].state, 'creating')
+        self.assertEqual(models[0].entered, ['creating'])
+        self.assertEqual(models[1].state, 'initial')
+        self.assertTrue(models[0].is_creating())
+        models[0].trigger('import_file')
+        self.assertEqual(models[0].state, 'importing')
+        self.assertIsInstance(_SlottedModel.__dict__['initialize'],
+                              wf._SharedTrigger)
+
+    def test_item_files_intern_directories_and_names(self):
+        files = wf.ItemFiles(self.table, original='/cam/a.mrc')
+        files['local_original'] = pathlib.Path('/scratch/p/a.mrc')
+        other = wf.ItemFiles(self.table, original='/cam/b.mrc')
+        self.assertEqual(files['local_original'],
+                         pathlib.Path('/scratch/p/a.mrc'))
+        self.assertEqual(files.entries['original'][0],
+                         other.entries['original'][0])
+        self.assertIs(files.entries['original'][1],
+                      files.entries['local_original'][1])
+        self.assertIn('original', files)
+        self.assertNotIn('local_stack', files)
+
+    def test_get_model_by_original_path(self):
+        model = _SlottedModel(self.workflow, self.table, '/cam/a.mrc')
+        self.workflow.add_model(model)
+        self.assertIs(self.workflow.get_model(pathlib.Path('/cam/a.mrc')),
+                      model)
+        with self.assertRaises(KeyError):
+            self.workflow.get_model('/cam/missing.mrc')
+        with self.assertRaises(KeyError):
+            self.workflow.get_model('/elsewhere/a.mrc')
+
+
+class _StubProject(wf.Project):
+    '''Just enough of a Project to drive items and the Scipion launch.
+    '''
+    SCIPION_ATTEMPTS = 2
+    SCIPION_HEALTH_TIMEOUT = 0.05
+    SCIPION_HEALTH_INTERVAL = 0.01
+    SCIPION_RETRY_DELAY = 0.2
+
+    def __init__(self, root, scipion_config=None):
+        self.project = 'stub'
+        self.workflow = wf.Workflow()
+        self.awh = wf.AsyncWorkflowHelper()
+        self.path_table = wf.PathTable()
+        self.scipion_state = None
+        self.stats = PipelineStats()
+        self.frames = 1
+        self.paths = {'local_root': str(root.joinpath('local')),
+                      'scratch_roots': [str(root.joinpath('scratch'))],
+                      'scipion_config': scipion_config}
+        for path in (self.paths['local_root'], *self.paths['scratch_roots']):
+            os.makedirs(path)
+        self.scratch = ScratchVolumes(self.paths['scratch_roots'])
+
+
+class ProjectTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.directory.name)
+        self.index = self.root.joinpath('www', 'stub', 'index.html')
+        self.starts = 0
+        self.started = lambda starts: None
+        self.patches = [
+            mock.patch.object(wf, 'SCIPION_PROJECTS',
+                              str(self.root.joinpath('projects'))),
+            mock.patch.object(wf, 'SCIPION_WEB_ROOT',
+                              str(self.root.joinpath('www'))),
+            mock.patch.object(wf, 'create_scipion_project',
+                              self.create_scipion_project),
+            mock.patch.object(wf, 'start_scipion_project',
+                              self.start_scipion_project)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.directory.cleanup()
+
+    async def create_scipion_project(self, project, config):
+        os.makedirs(os.path.join(wf.SCIPION_PROJECTS, project))
+
+    async def start_scipion_project(self, project):
+        self.starts += 1
+        self.started(self.starts)
+
+    def come_up(self):
+        os.makedirs(str(self.index.parent), exist_ok=True)
+        self.index.touch()
+
+    def run_until_launched(self, project):
+        async def wait():
+            while project.scipion_state == 'starting':
+                await asyncio.sleep(0.01)
+        self.loop.run_until_complete(wait())
+
+    def test_first_hand_off_launches_scipion(self):
+        project = _StubProject(self.root, scipion_config='scipion.conf')
+        self.started = lambda starts: self.come_up()
+        item = wf.WorkflowItem(self.root.joinpath('a.mrc'), project.workflow,
+                               project)
+        path = item._place(10).joinpath('a.mrc')
+        item._partial_path(path).write_bytes(b'data')
+        item._hand_off(path, scipion_input=True)
+        self.assertEqual(path.read_bytes(), b'data')
+        view = pathlib.Path(project.paths['local_root'], 'a.mrc')
+        self.assertEqual(os.readlink(str(view)), str(path))
+        self.assertEqual(project.scipion_state, 'starting')
+        self.run_until_launched(project)
+        self.assertEqual(project.scipion_state, 'running')
+        self.assertEqual(self.starts, 1)
+
+    def test_failed_start_is_retried(self):
+        project = _StubProject(self.root, scipion_config='scipion.conf')
+        self.started = lambda starts: self.come_up() if starts == 2 else None
+        self.assertEqual(
+            self.loop.run_until_complete(project._launch_scipion()), 2)
+        self.assertEqual(self.starts, 2)
+
+    def test_slow_start_is_not_started_again(self):
+        project = _StubProject(self.root, scipion_config='scipion.conf')
+        self.started = lambda starts: self.loop.call_later(0.1, self.come_up)
+        self.assertEqual(
+            self.loop.run_until_complete(project._launch_scipion()), 1)
+        self.assertEqual(self.starts, 1)
+
+    def test_launch_fails_after_every_attempt(self):
+        project = _StubProject(self.root, scipion_config='scipion.conf')
+        project.notify_scipion_input()
+        self.run_until_launched(project)
+        self.assertEqual(project.scipion_state, 'failed')
+        self.assertEqual(self.starts, project.SCIPION_ATTEMPTS)
+
+    def test_globus_task_followed_until_done(self):
+        project = _StubProject(self.root)
+        project.GLOBUS_POLL_INTERVAL = 0
+        statuses = iter(['ACTIVE', 'SUCCEEDED'])
+
+        async def task_status(task_id):
+            self.assertEqual(project.globus_status['task_id'], task_id)
+            return next(statuses)
+        project.globus_status = {'task_id': 'abc'}
+        with mock.patch.object(wf, 'globus_task_status', task_status):
+            self.assertEqual(self.loop.run_until_complete(
+                project._watch_globus_task('abc')), 'SUCCEEDED')
+        self.assertEqual(project.globus_status['status'], 'SUCCEEDED')
+
+    def test_backlog_admits_whole_movies_in_frames_mode(self):
+        project = _StubProject(self.root)
+        project.frames = 3
+        project.BACKLOG_MAX_ITEMS = 1
+        paths = []
+        for i, name in enumerate(['a_1', 'b_1', 'a_2', 'b_2', 'a_3', 'b_3']):
+            path = self.root.joinpath(name + '.tif')
+            path.touch()
+            os.utime(str(path), (1000 + i, 1000 + i))
+            paths.append(path)
+        admitted = []
+
+        def admit(path, backlog=False):
+            admitted.append(path.stem)
+            return types.SimpleNamespace(state='creating')
+        with mock.patch.object(project, '_admit', admit), \
+                mock.patch.object(project.awh, 'add_timed_callback'):
+            project._admit_backlog(paths)
+            self.assertEqual(admitted, ['a_1', 'a_2', 'a_3'])
+            for model in project.backlog.models:
+                model.state = 'finished'
+            project._admit_backlog_batch()
+        self.assertEqual(admitted[3:], ['b_1', 'b_2', 'b_3'])
+        self.assertEqual(len(project._backlog_paths), 0)
+
+    def test_failed_stacking_is_retried(self):
+        project = _StubProject(self.root)
+        item = wf.WorkflowItem(self.root.joinpath('a.mrc'), project.workflow,
+                               project)
+        project.workflow.add_model(item)
+        item.files['local_stack'] = item._place(10).joinpath('a.mrc')
+        fut = self.loop.create_future()
+        fut.set_result((b'', b'newstack: could not open input'))
+        with mock.patch.object(project.awh, 'add_timed_callback') as retry:
+            item._stacking_complete(fut)
+        self.assertEqual(retry.call_args[0][0].func,
+                         project.workflow.events['stack'].trigger)
+        self.assertIsNone(project.scipion_state)
+
+    def import_complete(self, name):
+        root = self.root.joinpath(name.replace('.', '_'))
+        project = _StubProject(root)
+        item = wf.WorkflowItem(root.joinpath(name), project.workflow,
+                               project)
+        project.workflow.add_model(item)
+        item.files['local_original'] = item._place(10).joinpath(name)
+        fut = self.loop.create_future()
+        fut.set_result('copy')
+        with mock.patch.object(wf.WorkflowItem,
+                               '_hand_off') as hand_off, \
+                mock.patch.object(wf.WorkflowItem, '_archive') as archive, \
+                mock.patch.object(wf.WorkflowItem,
+                                  'convert_to_mrc') as convert:
+            item._importing_complete(fut)
+        return item, hand_off, archive, convert
+
+    def test_direct_formats_skip_conversion(self):
+        for name in ('a.tif', 'a.eer', 'a.mrc'):
+            with self.subTest(name=name):
+                self.check_direct(*self.import_complete(name))
+
+    def check_direct(self, item, hand_off, archive, convert):
+        hand_off.assert_called_once_with(item.files['local_original'], True)
+        archive.assert_called_once_with()
+        convert.assert_not_called()
+        self.assertEqual(item.files['local_stack'],
+                         item.files['local_original'])
+
+    def test_dm4_is_converted(self):
+        item, hand_off, archive, convert = self.import_complete('a.dm4')
+        hand_off.assert_called_once_with(item.files['local_original'], False)
+        convert.assert_called_once_with()
+        archive.assert_not_called()
+
+
+class ProcessingOrderTests(unittest.TestCase):
+    '''Clean up waits for both verification and Scipion processing.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        root = pathlib.Path(self.directory.name)
+        self.project = _StubProject(root)
+        self.item = wf.WorkflowItem(root.joinpath('a.mrc'),
+                                    self.project.workflow, self.project)
+        self.project.workflow.add_model(self.item, initial='confirming')
+        self.item.files['local_stack'] = self.item._place(10).joinpath(
+            'a.mrc')
+        self.item.files['local_stack'].write_bytes(b'data')
+        self.processed = False
+        self.patch = mock.patch.object(
+            wf.WorkflowItem, '_is_processing_complete',
+            lambda item, path: self.processed)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.directory.cleanup()
+
+    def verify(self):
+        self.item._confirm_complete(None)
+
+    def process(self):
+        self.processed = True
+        self.item._poll_processing()
+
+    def test_verification_before_processing(self):
+        self.verify()
+        self.assertEqual(self.item.state, 'processing')
+        self.assertTrue(self.item.files['local_stack'].exists())
+        self.process()
+        self.assertEqual(self.item.state, 'finished')
+        self.assertFalse(self.item.files['local_stack'].exists())
+
+    def test_processing_before_verification(self):
+        self.process()
+        self.assertEqual(self.item.state, 'confirming')
+        self.assertTrue(self.item.files['local_stack'].exists())
+        self.verify()
+        self.assertEqual(self.item.state, 'finished')
+        self.assertFalse(self.item.files['local_stack'].exists())
@@ -0,0 +1,263 @@
+from collections import OrderedDict, deque
+from workflow.utilities import (HASH_BLOCK_SIZE, HASH_CHUNK_SIZE, HASH_FORMAT,
+                                _get_io_executor, _pwrite_all, _remove_partial,
+                                _tree_node)
+from workflow.throttle import acquire, get_limiter
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import struct
+import zlib
+
+CONTAINER_MAGIC = b'CRYOPAK1'
+CONTAINER_SUFFIX = '.pak'
+CONTAINER_CHUNK_SIZE = HASH_CHUNK_SIZE
+CONTAINER_WINDOW = 4
+CODEC_RAW = 'raw'
+CODEC_ZLIB = 'zlib'
+FOOTER = struct.Struct('<QQ8s')
+logger = logging.getLogger(__name__)
+
+
+async def pack_files(members, dest, chunk_size=CONTAINER_CHUNK_SIZE, level=1,
+                     min_ratio=0.9, window=CONTAINER_WINDOW):
+    '''Async pack several files into one container file.
+
+    Parameters:
+    members (iterable of (name, path)): member names and the files to pack
+    dest (string or pathlike object): path of the container to write
+    chunk_size (int): each member is split into chunks of this many bytes
+    level (int): zlib compression level for each chunk
+    min_ratio (float): chunks that do not compress below this ratio are
+        stored as-is
+    window (int): chunks read and compressed ahead of the writer
+
+    The container is laid out as
+        CONTAINER_MAGIC | chunk | chunk | ... | index | footer
+    Every chunk is compressed on its own on the shared I/O thread pool, so a
+    member can be read without decompressing anything before it. The index
+    is zlib-compressed JSON listing each member's size, mtime, tree_hash
+    digest and chunk offsets; the fixed-size footer points at the index.
+
+    Returns the index's list of members. The member digests are computed
+    from the data as it is packed and match tree_hash of the source files
+    when chunk_size is HASH_CHUNK_SIZE.
+    '''
+    loop = asyncio.get_event_loop()
+    executor = _get_io_executor()
+    limiter = get_limiter()
+    dest_buckets = limiter.buckets_for(dest)
+    index = []
+    fd_out = os.open(str(dest), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        _pwrite_all(fd_out, CONTAINER_MAGIC, 0)
+        offset = len(CONTAINER_MAGIC)
+        for name, path in members:
+            src_buckets = limiter.buckets_for(path)
+            fd_in = os.open(str(path), os.O_RDONLY)
+            pending = deque()
+            try:
+                stat = os.fstat(fd_in)
+                count = max(1, -(-stat.st_size // chunk_size))
+                chunks, leaves = [], []
+                for i in range(count):
+                    await acquire(src_buckets, min(
+                        chunk_size, stat.st_size - i * chunk_size))
+                    pending.append(loop.run_in_executor(
+                        executor, _pack_chunk, fd_in, i, count, chunk_size,
+                        level, min_ratio))
+                    while len(pending) >= window or (pending and
+                                                     i == count - 1):
+                        leaf, codec, blob = await pending.popleft()
+                        await acquire(dest_buckets, len(blob))
+                        await loop.run_in_executor(
+                            executor, _pwrite_all, fd_out, blob, offset)
+                        chunks.append([offset, len(blob), codec])
+                        leaves.append(leaf)
+                        offset += len(blob)
+            finally:
+                if pending:
+                    await asyncio.wait(pending)
+                os.close(fd_in)
+            root = _tree_node(0, 1, True, chunk_size)
+            for leaf in leaves:
+                root.update(leaf)
+            index.append({
+                'name': str(name),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'digest': HASH_FORMAT.format(chunk_size=chunk_size,
+                                             digest=root.hexdigest()),
+                'chunks': chunks})
+        encoded = zlib.compress(json.dumps(
+            {'chunk_size': chunk_size, 'members': index}).encode('utf8'))
+        _pwrite_all(fd_out, encoded + FOOTER.pack(offset, len(encoded),
+                                                  CONTAINER_MAGIC), offset)
+        await loop.run_in_executor(executor, os.fsync, fd_out)
+    except BaseException:
+        os.close(fd_out)
+        _remove_partial(dest)
+        raise
+    os.close(fd_out)
+    return index
+
+
+def _pack_chunk(fd, index, count, chunk_size, level, min_ratio):
+    '''Read, hash and compress one chunk. Runs in the I/O thread pool.
+    '''
+    offset = index * chunk_size
+    data = _pread_exact(fd, chunk_size, offset, partial=True)
+    node = _tree_node(index, 0, index == count - 1, chunk_size)
+    node.update(data)
+    blob = zlib.compress(data, level)
+    if len(blob) >= min_ratio * len(data):
+        return node.digest(), CODEC_RAW, data
+    return node.digest(), CODEC_ZLIB, blob
+
+
+def _pread_exact(fd, count, offset, partial=False):
+    '''Read count bytes at offset, or up to end of file if partial.
+    '''
+    blocks = []
+    end = offset + count
+    while offset < end:
+        block = os.pread(fd, min(HASH_BLOCK_SIZE, end - offset), offset)
+        if not block:
+            if partial:
+                break
+            raise EOFError('Unexpected end of file at offset {0}'
+                           .format(offset))
+        blocks.append(block)
+        offset += len(block)
+    return b''.join(blocks)
+
+
+class ContainerReader():
+    '''Random access to the members of a container written by pack_files.
+
+    Only the footer and index are read on open. Members, or single chunks of
+    a member, are read and decompressed on demand.
+    '''
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._fd = os.open(str(self.path), os.O_RDONLY)
+        try:
+            size = os.fstat(self._fd).st_size
+            if size < len(CONTAINER_MAGIC) + FOOTER.size:
+                raise ValueError('{0} is not a container'.format(self.path))
+            offset, length, magic = FOOTER.unpack(
+                os.pread(self._fd, FOOTER.size, size - FOOTER.size))
+            head = os.pread(self._fd, len(CONTAINER_MAGIC), 0)
+            if magic != CONTAINER_MAGIC or head != CONTAINER_MAGIC:
+                raise ValueError('{0} is not a container'.format(self.path))
+            index = json.loads(zlib.decompress(
+                _pread_exact(self._fd, length, offset)).decode('utf8'))
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self.chunk_size = index['chunk_size']
+        self.members = OrderedDict(
+            (member['name'], member) for member in index['members'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def names(self):
+        return list(self.members)
+
+    def iter_chunk(self, name, index):
+        '''Yield the uncompressed data of one chunk of a member in blocks.
+        '''
+        offset, length, codec = self.members[name]['chunks'][index]
+        decompressor = zlib.decompressobj() if codec == CODEC_ZLIB else None
+        end = offset + length
+        while offset < end:
+            block = _pread_exact(self._fd, min(HASH_BLOCK_SIZE, end - offset),
+                                 offset)
+            offset += len(block)
+            yield decompressor.decompress(block) if decompressor else block
+        if decompressor:
+            yield decompressor.flush()
+
+    def read_chunk(self, name, index):
+        return b''.join(self.iter_chunk(name, index))
+
+    def read(self, name):
+        '''Return the whole contents of a member.
+        '''
+        return b''.join(self.read_chunk(name, i)
+                        for i in range(len(self.members[name]['chunks'])))
+
+    def extract(self, name, dest):
+        '''Write a member to dest, restoring its mtime.
+        '''
+        member = self.members[name]
+        with open(str(dest), mode='wb') as out:
+            for i in range(len(member['chunks'])):
+                for block in self.iter_chunk(name, i):
+                    out.write(block)
+        os.utime(str(dest), (member['mtime'], member['mtime']))
+
+    def _hash_chunk(self, name, index):
+        '''Hash one uncompressed chunk as a tree leaf. Runs in the I/O pool.
+        '''
+        count = len(self.members[name]['chunks'])
+        node = _tree_node(index, 0, index == count - 1, self.chunk_size)
+        for block in self.iter_chunk(name, index):
+            node.update(block)
+        return node.digest()
+
+
+async def verify_container(path, digests=None):
+    '''Async check the members of a container against their digests.
+
+    Parameters:
+    path (string or pathlike object): the container to check
+    digests (dict): expected digest for each member name. Defaults to the
+        digests recorded in the container's own index.
+
+    Every chunk is decompressed and hashed in parallel on the shared I/O
+    thread pool, within the bandwidth limit of the container's mount.
+    Returns the names of the members that are missing or whose data does
+    not match; an empty list means the container is good.
+    '''
+    loop = asyncio.get_event_loop()
+    buckets = get_limiter().buckets_for(path)
+    failed = []
+
+    async def hash_chunk(reader, name, index):
+        await acquire(buckets, reader.members[name]['chunks'][index][1])
+        return await loop.run_in_executor(
+            _get_io_executor(), reader._hash_chunk, name, index)
+    with ContainerReader(path) as reader:
+        if digests is None:
+            digests = {name: member['digest']
+                       for name, member in reader.members.items()}
+        for name, expected in digests.items():
+            if name not in reader.members:
+                failed.append(name)
+                continue
+            leaves = await asyncio.gather(*[
+                hash_chunk(reader, name, i)
+                for i in range(len(reader.members[name]['chunks']))])
+            root = _tree_node(0, 1, True, reader.chunk_size)
+            for leaf in leaves:
+                root.update(leaf)
+            digest = HASH_FORMAT.format(chunk_size=reader.chunk_size,
+                                        digest=root.hexdigest())
+            if digest != expected:
+                logger.warning('Digest mismatch for {0} in {1}: {2} != {3}'
+                               .format(name, path, digest, expected))
+                failed.append(name)
+    return failed
@@ -0,0 +1,188 @@
+from collections import Counter
+import asyncio
+import functools
+import io
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def describe_owner(owner):
+    '''Describe the object a task belongs to, with its workflow state.
+    '''
+    if owner is None:
+        return 'no owner'
+    files = getattr(owner, 'files', None)
+    if files and 'original' in files:
+        return '{0} {1} state={2}'.format(
+            type(owner).__name__, files['original'],
+            getattr(owner, 'state', None))
+    return repr(owner)
+
+
+def dump_tasks(awh, out):
+    '''Write every pending task, and queued stage work, with its owner.
+
+    Parameters:
+    awh (AsyncWorkflowHelper): helper whose loop and owners are dumped
+    out (file-like object): where to write the dump
+    '''
+    all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+    tasks = [task for task in all_tasks(awh.loop) if not task.done()]
+    out.write('{0} pending tasks\n'.format(len(tasks)))
+    for task in tasks:
+        out.write('\n{0!r}\n  owner: {1}\n'.format(
+            task, describe_owner(awh.owners.get(task))))
+        task.print_stack(file=out)
+    for priority, queue in sorted(awh.scheduler.queues.items()):
+        out.write('\n{0} queued at priority {1}\n'.format(len(queue),
+                                                          priority))
+        for key, _, coro, done_cb in sorted(queue, key=lambda e: e[:2]):
+            out.write('  {0} key={1} owner: {2}\n'.format(
+                coro.__qualname__, key,
+                describe_owner(getattr(done_cb, '__self__', None))))
+
+
+class SamplingProfiler():
+    '''Low-overhead sampling profiler writing collapsed stacks.
+
+    A background thread samples the stack of every other thread each
+    `interval` seconds. The output has one 'frame;frame;frame count' line per
+    distinct stack, as consumed by flamegraph.pl and similar tools.
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.samples.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='sampling-profiler',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, path):
+        '''Stop sampling and write the collapsed stacks to path.
+        '''
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        with open(str(path), mode='w', encoding='utf8') as f:
+            for stack, count in self.samples.most_common():
+                f.write('{0} {1}\n'.format(stack, count))
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    stack.append('{0}:{1}'.format(
+                        os.path.basename(frame.f_code.co_filename),
+                        frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[';'.join(reversed(stack))] += 1
+
+
+class CallbackProfiler():
+    '''Record execution time of classes' on_enter_* state callbacks.
+
+    transitions looks callbacks up by name on the model, so wrapping them on
+    the class is enough to time every model. Each class's own callbacks are
+    wrapped, so a subclass is installed as well as its base; a callback it
+    overrides is reported as Class.on_enter_*.
+    '''
+
+    def __init__(self, prefix='on_enter_'):
+        self.prefix = prefix
+        self.calls = Counter()
+        self.total = Counter()
+        self.worst = Counter()
+        self._owners = {}
+
+    def install(self, *classes):
+        for cls in classes:
+            for name, func in list(vars(cls).items()):
+                if not name.startswith(self.prefix) or not callable(func):
+                    continue
+                key = name
+                if self._owners.setdefault(name, cls) is not cls:
+                    key = '{0}.{1}'.format(cls.__name__, name)
+                setattr(cls, name, self._wrap(key, func))
+
+    def _wrap(self, name, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.calls[name] += 1
+                self.total[name] += elapsed
+                self.worst[name] = max(self.worst[name], elapsed)
+        return timed
+
+    def report(self, out):
+        out.write('{0:36s} {1:>8s} {2:>12s} {3:>12s} {4:>12s}\n'.format(
+            'callback', 'calls', 'total s', 'mean ms', 'max ms'))
+        for name, total in self.total.most_common():
+            out.write('{0:36s} {1:8d} {2:12.3f} {3:12.3f} {4:12.3f}\n'.format(
+                name, self.calls[name], total,
+                1000 * total / self.calls[name], 1000 * self.worst[name]))
+
+
+def install_signal_handlers(awh, output_dir, callbacks=None):
+    '''Install the diagnostic signal handlers on the helper's loop.
+
+    SIGUSR1 logs all pending asyncio tasks with their coroutine stacks and
+    owning WorkflowItem, plus the callback timings if callbacks is given.
+    SIGUSR2 starts the sampling profiler, and on the next SIGUSR2 stops it
+    and writes collapsed stacks to output_dir.
+    '''
+    profiler = SamplingProfiler()
+
+    def on_dump():
+        out = io.StringIO()
+        dump_tasks(awh, out)
+        if callbacks is not None:
+            out.write('\n')
+            callbacks.report(out)
+        logger.info('Task dump\n{0}'.format(out.getvalue()))
+
+    def on_profile():
+        if profiler.running:
+            path = os.path.join(str(output_dir), 'profile-{0}-{1}.collapsed'
+                                .format(os.getpid(), int(time.time())))
+            profiler.stop(path)
+            logger.info('Sampling profiler stopped, wrote {0}'.format(path))
+        else:
+            profiler.start()
+            logger.info('Sampling profiler started')
+
+    awh.loop.add_signal_handler(signal.SIGUSR1, on_dump)
+    awh.loop.add_signal_handler(signal.SIGUSR2, on_profile)
+    return profiler
@@ -0,0 +1,95 @@
+import functools
+import heapq
+import itertools
+import logging
+import math
+
+HIGH = 0
+LOW = 1
+logger = logging.getLogger(__name__)
+
+
+class StageScheduler():
+    '''Run workflow stage coroutines in a fixed number of slots by priority.
+
+    Work is submitted in one of two priority classes. HIGH is for the stages
+    that feed Scipion (import, convert, stack) and LOW is for archival work
+    (compress, export, verify). Within a class, work with the lowest key runs
+    first. When both classes are waiting, LOW is still guaranteed at least
+    low_share of the slots that open up, so a steady stream of new movies
+    cannot starve the backlog. LOW work never holds more than
+    slots - high_reserved slots, so new HIGH work always finds one free
+    even when the backlog of archival work is long.
+
+    Keyword arguments:
+    slots -- maximum number of stage coroutines running at once
+    low_share -- minimum fraction (0, 1] of dispatches given to LOW work
+    high_reserved -- slots LOW work may not use (at most slots - 1)
+    owners -- optional mapping filled with task -> owner of its done_cb
+    '''
+
+    def __init__(self, loop, slots=6, low_share=0.25, high_reserved=1,
+                 owners=None):
+        if not 0 < low_share <= 1:
+            raise ValueError('low_share must be in the range (0, 1]')
+        self.loop = loop
+        self.slots = slots
+        self.low_share = low_share
+        self.low_slots = slots - max(0, min(high_reserved, slots - 1))
+        self.queues = {HIGH: [], LOW: []}
+        self.running = 0
+        self.running_low = 0
+        self.owners = owners
+        self._counter = itertools.count()
+        self._high_per_low = math.ceil((1 - low_share) / low_share)
+        self._high_since_low = 0
+
+    def submit(self, coro, done_cb=None, priority=HIGH, key=0):
+        '''Queue the coroutine and start it as soon as a slot is free.
+        '''
+        heapq.heappush(self.queues[priority],
+                       (key, next(self._counter), coro, done_cb))
+        self._dispatch()
+
+    def depth(self, priority=None):
+        '''Number of queued (not yet running) coroutines.
+        '''
+        if priority is None:
+            return sum(len(queue) for queue in self.queues.values())
+        return len(self.queues[priority])
+
+    def _next_priority(self):
+        high, low = self.queues[HIGH], self.queues[LOW]
+        if self.running_low >= self.low_slots:
+            low = None
+        if low and (not high or self._high_since_low >= self._high_per_low):
+            return LOW
+        elif high:
+            return HIGH
+        else:
+            return None
+
+    def _dispatch(self):
+        while self.running < self.slots:
+            priority = self._next_priority()
+            if priority is None:
+                return
+            key, _, coro, done_cb = heapq.heappop(self.queues[priority])
+            if priority == LOW:
+                self._high_since_low = 0
+                self.running_low += 1
+            else:
+                self._high_since_low += 1
+            self.running += 1
+            task = self.loop.create_task(coro)
+            task.add_done_callback(
+                functools.partial(self._task_done, priority=priority))
+            task.add_done_callback(done_cb) if done_cb else None
+            if self.owners is not None:
+                self.owners[task] = getattr(done_cb, '__self__', None)
+
+    def _task_done(self, fut, priority=HIGH):
+        self.running -= 1
+        if priority == LOW:
+            self.running_low -= 1
+        self._dispatch()
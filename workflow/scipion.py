@@ -6,6 +6,8 @@ import pathlib
 import sys
 
 APPLICATION_PATH = os.path.realpath(sys.path[0])
+INPUT_SUFFIXES = ('.mrc', '.mrcs', '.tif', '.tiff', '.eer')
+STACK_SUFFIX = '.mrc'
 
 
 class Config():
@@ -86,8 +88,10 @@ class Config():
         imp['filesPath'] = str(pathlib.Path(
                             config.working_directory,
                             config.project_name))
-        imp['filesPattern'] = ('stack/*.mrc' if config.frames_to_stack > 1
-                               else '*.mrc')
+        imp['filesPattern'] = ('stack/*' + STACK_SUFFIX
+                               if config.frames_to_stack > 1
+                               else '*' + Config._input_suffix(
+                                   config.source_pattern))
         imp['magnification'] = (((config.physical_pixel_size * .000001) /
                                 (config.image_pixel_size * .0000000001)) /
                                 (2 if config.super_resolution else 1))
@@ -100,6 +104,18 @@ class Config():
         ctf['lowRes'] = config.image_pixel_size / config.ctf_low_res
         ctf['highRes'] = config.image_pixel_size / config.ctf_high_res
 
+    @staticmethod
+    def _input_suffix(pattern):
+        '''Return the suffix of the files Scipion will import.
+
+        Formats that the workflow converts (DM4) are imported as MRC; any
+        other supported format is imported as-is.
+        '''
+        suffix = pathlib.Path(pattern).suffix
+        if suffix.lower() in INPUT_SUFFIXES:
+            return suffix
+        return '.mrc'
+
     def get_config_values(self):
         self._get_config_values(self)
 
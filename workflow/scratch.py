@@ -0,0 +1,112 @@
+import logging
+import os
+import threading
+
+DEFAULT_RATE = 500 * 1024 * 1024
+DISKSTATS = '/proc/diskstats'
+SECTOR_SIZE = 512
+logger = logging.getLogger(__name__)
+
+
+class ScratchVolume():
+    '''A local scratch directory and its current load.
+    '''
+
+    def __init__(self, root, rate=DEFAULT_RATE):
+        self.root = str(root)
+        self.in_flight = 0
+        self.rate = rate
+        self.device = None
+        self.counters = None
+
+    def __repr__(self):
+        return 'ScratchVolume({0!r})'.format(self.root)
+
+
+class ScratchVolumes():
+    '''Place workflow items across one or more local scratch volumes.
+
+    Each item is placed on the volume that would take the least time to work
+    through its bytes in flight, estimated from recently observed I/O
+    throughput. All of an item's intermediates stay on the volume it was
+    placed on, so the reservation is held until release.
+
+    Throughput is sampled from the block device under each volume (see
+    sample), so it counts every read and write that reaches the volume,
+    whichever stage or tool made it. Volumes not backed by a block device
+    listed in /proc/diskstats, such as tmpfs, keep DEFAULT_RATE.
+
+    Keyword arguments:
+    alpha -- weight of the newest sample in the throughput moving average
+    '''
+
+    def __init__(self, roots, alpha=0.3):
+        self.volumes = [ScratchVolume(root) for root in roots]
+        self.alpha = alpha
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return iter(self.volumes)
+
+    @property
+    def in_flight(self):
+        '''Bytes reserved across all volumes.
+        '''
+        return sum(volume.in_flight for volume in self.volumes)
+
+    def select(self, nbytes):
+        '''Reserve nbytes on the least-loaded volume and return it.
+        '''
+        with self._lock:
+            volume = min(self.volumes,
+                         key=lambda v: (v.in_flight + nbytes) / v.rate)
+            volume.in_flight += nbytes
+        logger.debug('Placed {0} bytes on {1}'.format(nbytes, volume.root))
+        return volume
+
+    def release(self, volume, nbytes):
+        with self._lock:
+            volume.in_flight = max(0, volume.in_flight - nbytes)
+
+    def sample(self, path=DISKSTATS):
+        '''Fold each volume's device throughput since the last sample in.
+
+        The bytes read and written on the volume's device are divided by
+        the time the device was busy, so idle time does not lower the rate
+        and a busy device shows what it sustains under load.
+        '''
+        try:
+            with open(path, mode='r', encoding='utf8') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return
+        counters = {}
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 13:
+                continue
+            counters[(int(fields[0]), int(fields[1]))] = (
+                (int(fields[5]) + int(fields[9])) * SECTOR_SIZE,
+                int(fields[12]) / 1000)
+        for volume in self.volumes:
+            if volume.device is None:
+                try:
+                    dev = os.stat(volume.root).st_dev
+                except OSError:
+                    continue
+                volume.device = (os.major(dev), os.minor(dev))
+            now = counters.get(volume.device)
+            if now is None:
+                continue
+            last, volume.counters = volume.counters, now
+            if last is not None:
+                self.record(volume, now[0] - last[0], now[1] - last[1])
+
+    def record(self, volume, nbytes, seconds):
+        '''Fold an observed transfer into the volume's throughput estimate.
+        '''
+        if nbytes <= 0 or seconds <= 0:
+            return
+        with self._lock:
+            volume.rate = ((1 - self.alpha) * volume.rate +
+                           self.alpha * nbytes / seconds)
@@ -0,0 +1,259 @@
+from collections import Counter, deque
+from workflow.scheduler import HIGH, LOW
+from workflow.throttle import get_limiter
+import asyncio
+import json
+import logging
+import re
+import shutil
+import time
+
+THROUGHPUT_WINDOWS = {'5m': 300, '60m': 3600}
+TCP_ADDRESS = re.compile(r'^(?:([\w.-]+):)?(\d+)$')
+logger = logging.getLogger(__name__)
+
+
+class PipelineStats():
+    '''Rolling record of finished items for throughput reporting.
+    '''
+
+    def __init__(self, horizon=max(THROUGHPUT_WINDOWS.values())):
+        self.horizon = horizon
+        self.finished = deque()
+
+    def record(self, nbytes, now=None):
+        now = time.time() if now is None else now
+        self.finished.append((now, nbytes))
+        self._prune(now)
+
+    def throughput(self, window, now=None):
+        '''Return (items/s, bytes/s) over the last `window` seconds.
+        '''
+        now = time.time() if now is None else now
+        self._prune(now)
+        recent = [nbytes for stamp, nbytes in self.finished
+                  if stamp >= now - window]
+        return len(recent) / window, sum(recent) / window
+
+    def _prune(self, now):
+        while self.finished and self.finished[0][0] < now - self.horizon:
+            self.finished.popleft()
+
+
+class BacklogProgress():
+    '''Progress and ETA for the files that existed when the pipeline started.
+
+    The backlog is admitted a few files at a time, so total may be larger
+    than the number of models added so far.
+    '''
+
+    def __init__(self, models, start=None, total=None):
+        self.models = list(models)
+        self.start = time.time() if start is None else start
+        self.total = len(self.models) if total is None else total
+
+    def add(self, model):
+        self.models.append(model)
+
+    @property
+    def in_flight(self):
+        return sum(model.state != 'finished' for model in self.models)
+
+    @property
+    def complete(self):
+        return (len(self.models) >= self.total and
+                all(model.state == 'finished' for model in self.models))
+
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        done = sum(model.state == 'finished' for model in self.models)
+        total = self.total
+        elapsed = max(now - self.start, 1e-6)
+        rate = done / elapsed
+        eta = (total - done) / rate if rate else None
+        return {'total': total, 'done': done, 'elapsed': elapsed,
+                'items_per_second': rate, 'eta_seconds': eta}
+
+    def log(self):
+        snap = self.snapshot()
+        logger.info('Backlog: {0}/{1} finished, {2:.3f} items/s, ETA {3}'
+                    .format(snap['done'], snap['total'],
+                            snap['items_per_second'],
+                            'unknown' if snap['eta_seconds'] is None
+                            else '{0:.0f} s'.format(snap['eta_seconds'])))
+
+
+class StatusServer():
+    '''Serve the status of a running Project as JSON and Prometheus text.
+
+    Listens on a TCP port if address is 'port' or 'host:port' (host defaults
+    to 127.0.0.1), otherwise on a Unix socket at that path. Responds to
+    HTTP GET on /status (JSON) and /metrics (Prometheus text format).
+
+    The server shares the event loop with the workflow callbacks, so each
+    snapshot is cached for cache_time seconds and requests that do not
+    arrive within request_timeout seconds are dropped.
+    '''
+
+    def __init__(self, project, address, cache_time=1, request_timeout=5):
+        self.project = project
+        self.address = str(address)
+        self.cache_time = cache_time
+        self.request_timeout = request_timeout
+        self.server = None
+        self._snapshot = None
+        self._snapshot_time = 0
+
+    async def start(self):
+        match = TCP_ADDRESS.match(self.address)
+        if match:
+            host, port = match.groups()
+            self.server = await asyncio.start_server(
+                self._handle, host=host or '127.0.0.1', port=int(port))
+        else:
+            self.server = await asyncio.start_unix_server(
+                self._handle, path=self.address)
+        logger.info('Status server listening on {0}'.format(self.address))
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    def snapshot(self):
+        '''Return the current status as a dict, cached for cache_time.
+        '''
+        now = time.time()
+        if (self._snapshot is None or
+                now - self._snapshot_time > self.cache_time):
+            self._snapshot = self._collect(now)
+            self._snapshot_time = now
+        return self._snapshot
+
+    def _collect(self, now):
+        project = self.project
+        scheduler = project.awh.scheduler
+        states = Counter(model.state for model in project.workflow.models[1:])
+        throughput = {}
+        for name, window in THROUGHPUT_WINDOWS.items():
+            items, nbytes = project.stats.throughput(window, now)
+            throughput[name] = {'items_per_second': items,
+                                'bytes_per_second': nbytes}
+        scratch = {}
+        for root in project.paths.get('scratch_roots',
+                                      [project.paths['local_root']]):
+            try:
+                usage = shutil.disk_usage(root)
+            except OSError:
+                continue
+            scratch[root] = {'total': usage.total, 'used': usage.used,
+                             'free': usage.free}
+        return {
+            'project': project.project,
+            'time': now,
+            'states': dict(states),
+            'queues': {'high': scheduler.depth(HIGH),
+                       'low': scheduler.depth(LOW),
+                       'running': scheduler.running},
+            'throughput': throughput,
+            'scratch_bytes': scratch,
+            'seconds_since_new_file': now - project.monitor.base_time,
+            'globus': dict(project.globus_status),
+            'bandwidth': get_limiter().snapshot(),
+            'backlog': (project.backlog.snapshot(now)
+                        if getattr(project, 'backlog', None) else None),
+        }
+
+    @staticmethod
+    def format_prometheus(snapshot):
+        '''Render a snapshot in the Prometheus text exposition format.
+        '''
+        prefix = 'cryoem_pipeline_'
+        lines = []
+
+        def escape(value):
+            return (str(value).replace('\\', '\\\\')
+                    .replace('"', '\\"').replace('\n', '\\n'))
+
+        def metric(name, kind, samples):
+            lines.append('# TYPE {0}{1} {2}'.format(prefix, name, kind))
+            for labels, value in samples:
+                label = ','.join('{0}="{1}"'.format(k, escape(v))
+                                 for k, v in sorted(labels.items()))
+                lines.append('{0}{1}{2} {3}'.format(
+                    prefix, name, '{' + label + '}' if label else '',
+                    float(value)))
+
+        metric('items', 'gauge',
+               [({'state': k}, v) for k, v in snapshot['states'].items()])
+        metric('queue_depth', 'gauge',
+               [({'priority': k}, v) for k, v in snapshot['queues'].items()
+                if k != 'running'])
+        metric('stages_running', 'gauge',
+               [({}, snapshot['queues']['running'])])
+        metric('throughput_items_per_second', 'gauge',
+               [({'window': k}, v['items_per_second'])
+                for k, v in snapshot['throughput'].items()])
+        metric('throughput_bytes_per_second', 'gauge',
+               [({'window': k}, v['bytes_per_second'])
+                for k, v in snapshot['throughput'].items()])
+        metric('scratch_bytes', 'gauge',
+               [({'volume': volume, 'kind': k}, v)
+                for volume, usage in snapshot['scratch_bytes'].items()
+                for k, v in usage.items()])
+        metric('seconds_since_new_file', 'gauge',
+               [({}, snapshot['seconds_since_new_file'])])
+        globus = snapshot['globus']
+        if globus.get('status') is not None:
+            metric('globus_task_status', 'gauge',
+                   [({'status': globus['status']}, 1)])
+        if globus.get('last_submit') is not None:
+            metric('globus_last_submit_timestamp', 'gauge',
+                   [({}, globus['last_submit'])])
+        bandwidth = snapshot.get('bandwidth', {})
+        metric('bandwidth_limit_bytes_per_second', 'gauge',
+               [({'mount': k}, v['limit'])
+                for k, v in bandwidth.items() if v['limit']])
+        metric('bandwidth_bytes_total', 'counter',
+               [({'mount': k}, v['bytes']) for k, v in bandwidth.items()])
+        metric('bandwidth_throttled_seconds_total', 'counter',
+               [({'mount': k}, v['throttled_seconds'])
+                for k, v in bandwidth.items()])
+        backlog = snapshot.get('backlog')
+        if backlog:
+            metric('backlog_items', 'gauge',
+                   [({'kind': 'total'}, backlog['total']),
+                    ({'kind': 'done'}, backlog['done'])])
+            if backlog['eta_seconds'] is not None:
+                metric('backlog_eta_seconds', 'gauge',
+                       [({}, backlog['eta_seconds'])])
+        return '\n'.join(lines) + '\n'
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(
+                reader.readuntil(b'\r\n\r\n'), self.request_timeout)
+            method, path = request.split(b' ')[:2]
+            path = path.decode('ascii', 'replace').split('?')[0]
+            if method != b'GET':
+                status, ctype, body = '405 Method Not Allowed', 'text/plain', \
+                    'Method not allowed\n'
+            elif path == '/status':
+                status, ctype = '200 OK', 'application/json'
+                body = json.dumps(self.snapshot(), sort_keys=True) + '\n'
+            elif path == '/metrics':
+                status, ctype = '200 OK', 'text/plain; version=0.0.4'
+                body = self.format_prometheus(self.snapshot())
+            else:
+                status, ctype, body = '404 Not Found', 'text/plain', \
+                    'Not found\n'
+            body = body.encode('utf8')
+            writer.write('HTTP/1.0 {0}\r\nContent-Type: {1}\r\n'
+                         'Content-Length: {2}\r\nConnection: close\r\n\r\n'
+                         .format(status, ctype, len(body)).encode('ascii'))
+            writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
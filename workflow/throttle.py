@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import os
+import signal
+import threading
+import time
+
+RATE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+UNLIMITED = ('', '0', 'none', 'off', 'unlimited')
+logger = logging.getLogger(__name__)
+_limiter = None
+
+
+def parse_rate(text):
+    '''Parse a rate like '200M' or '1.5G' (bytes per second, binary units).
+
+    Returns None for no limit ('0', 'none', 'off' or 'unlimited').
+    '''
+    text = str(text).strip()
+    if text.lower() in UNLIMITED:
+        return None
+    text = text.upper().rstrip('B').rstrip('I')
+    unit = text[-1] if text[-1] in RATE_UNITS else ''
+    rate = float(text[:len(text) - len(unit)]) * RATE_UNITS[unit]
+    if rate < 0:
+        raise ValueError('Rate must not be negative: {0}'.format(text))
+    return rate or None
+
+
+def format_rate(rate):
+    if not rate:
+        return 'unlimited'
+    for unit in ('G', 'M', 'K'):
+        if rate >= RATE_UNITS[unit]:
+            return '{0:.4g}{1}/s'.format(rate / RATE_UNITS[unit], unit)
+    return '{0:.4g}/s'.format(rate)
+
+
+def mount_point(path):
+    '''Return the mount point of path, or of its nearest existing parent.
+    '''
+    path = os.path.realpath(str(path))
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+class TokenBucket():
+    '''Token bucket limiting the bytes per second through one mount point.
+
+    Callers reserve bytes up front and are told how long to wait; the bucket
+    may go into debt, so concurrent callers queue behind each other instead
+    of all waking at once. A rate of None means no limit, but bytes are
+    still counted.
+    '''
+
+    def __init__(self, name, rate=None, burst=None):
+        self.name = name
+        self.rate = None
+        self.burst = 0
+        self.tokens = 0
+        self.bytes = 0
+        self.waited = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        '''Change the rate. burst defaults to one second at the new rate.
+        '''
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate or None
+            self.burst = burst or rate or 0
+            self.tokens = min(self.tokens, self.burst)
+
+    def reserve(self, nbytes):
+        '''Take nbytes from the bucket, return the seconds to wait first.
+        '''
+        with self._lock:
+            self.bytes += nbytes
+            if self.rate is None:
+                return 0
+            self._refill(time.monotonic())
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += wait
+            return wait
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+
+class BandwidthLimiter():
+    '''The token buckets for every mount point data is copied through.
+
+    A bucket is made, unlimited, for each mount point the first time a path
+    on it is used, so limits set later also apply to transfers already under
+    way.
+    '''
+
+    def __init__(self):
+        self.buckets = {}
+        self._mounts = {}
+        self._loaded = set()
+        self._lock = threading.Lock()
+
+    def bucket(self, path):
+        '''Return the bucket for the mount point path is on.
+
+        Mount points are cached by directory, so files that do not exist yet
+        can be looked up cheaply.
+        '''
+        path = os.path.abspath(str(path))
+        directory = path if os.path.isdir(path) else os.path.dirname(path)
+        mount = self._mounts.get(directory)
+        if mount is None:
+            mount = self._mounts[directory] = mount_point(directory)
+        with self._lock:
+            if mount not in self.buckets:
+                self.buckets[mount] = TokenBucket(mount)
+            return self.buckets[mount]
+
+    def buckets_for(self, *paths):
+        '''Return the distinct buckets for the mount points of paths.
+        '''
+        buckets = []
+        for path in paths:
+            bucket = self.bucket(path)
+            if bucket not in buckets:
+                buckets.append(bucket)
+        return buckets
+
+    def set_limit(self, path, rate, burst=None):
+        '''Limit the mount point that path is on to rate bytes per second.
+        '''
+        bucket = self.bucket(path)
+        if rate != bucket.rate:
+            logger.info('Bandwidth limit for {0}: {1} (was {2})'.format(
+                bucket.name, format_rate(rate), format_rate(bucket.rate)))
+        bucket.set_rate(rate, burst)
+        return bucket
+
+    def load(self, path):
+        '''Set limits from a file of 'PATH RATE' lines.
+
+        Blank lines and lines starting with # are ignored. Mounts that were
+        limited by a previous load but are no longer listed are unlimited.
+        Safe to call again at any time to apply an edited file.
+        '''
+        loaded = set()
+        with open(str(path), mode='r', encoding='utf8') as f:
+            for number, line in enumerate(f, 1):
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                try:
+                    where, rate = line.rsplit(None, 1)
+                    bucket = self.set_limit(where, parse_rate(rate))
+                except ValueError:
+                    logger.warning('Ignoring line {0} of {1}: {2}'.format(
+                        number, path, line))
+                    continue
+                loaded.add(bucket.name)
+        for name in self._loaded - loaded:
+            self.set_limit(name, None)
+        self._loaded = loaded
+
+    def snapshot(self):
+        return {name: {'limit': bucket.rate, 'bytes': bucket.bytes,
+                       'throttled_seconds': bucket.waited}
+                for name, bucket in self.buckets.items()}
+
+
+def get_limiter():
+    '''Return the bandwidth limiter shared by the in-process I/O functions.
+    '''
+    global _limiter
+    if _limiter is None:
+        _limiter = BandwidthLimiter()
+    return _limiter
+
+
+async def acquire(buckets, nbytes):
+    '''Async wait until nbytes may pass through all of buckets.
+    '''
+    wait = max([bucket.reserve(nbytes) for bucket in buckets] or [0])
+    if wait > 0:
+        await asyncio.sleep(wait)
+
+
+def install_reload_handler(loop, path):
+    '''Load the limits file now and again on every SIGHUP.
+    '''
+    def on_reload():
+        try:
+            get_limiter().load(path)
+        except OSError as e:
+            logger.warning('Could not load bandwidth limits from {0}: {1}'
+                           .format(path, e))
+    on_reload()
+    loop.add_signal_handler(signal.SIGHUP, on_reload)
@@ -1,12 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import CalledProcessError
+from workflow.throttle import acquire, get_limiter
 import asyncio
 import errno
+import fcntl
+import hashlib
 import logging
 import os
 import pathlib
-from subprocess import CalledProcessError
-
-
+import time
+import zlib
+
+
+HASH_CHUNK_SIZE = 64 * 1024 * 1024
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+HASH_DIGEST_SIZE = 32
+HASH_FORMAT = 'blake2b-tree:{chunk_size}:{digest}'
+DIGEST_SUFFIX = '.b2tree'
+IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+COPY_SEGMENT_SIZE = 64 * 1024 * 1024
+COPY_BLOCK_SIZE = 8 * 1024 * 1024
+COPY_MIN_PARALLEL_SIZE = 256 * 1024 * 1024
+COPY_STREAMS = 4
+COPY_MAX_STREAMS = 16
+TEE_QUEUE_BLOCKS = 8
+FICLONE = 0x40049409
+PROBE_BLOCKS = 8
+PROBE_BLOCK_SIZE = 1024 * 1024
 logger = logging.getLogger(__name__)
+_io_executor = None
 
 
 async def safe_copy_file(src, dest):
@@ -28,38 +50,665 @@ async def safe_copy_file(src, dest):
     return await _wait_subprocess_exec(cmd)
 
 
-async def file_hash(path):
-    '''Async get the sha1 hash of the given file using system shasum.
+async def parallel_copy_file(src, dest, streams=COPY_STREAMS,
+                             max_streams=COPY_MAX_STREAMS,
+                             segment_size=COPY_SEGMENT_SIZE,
+                             min_size=COPY_MIN_PARALLEL_SIZE):
+    '''Async copy the file from src to dest using concurrent ranged reads.
 
     Parameters:
-    path (string or pathlike object): the path to the file to hash
+    src (string or pathlike object): path to the source file
+    dest (string or pathlike object): path to the destination
+    streams (int): number of concurrent readers to start with
+    max_streams (int): upper bound for the number of concurrent readers
+    segment_size (int): size in bytes of each range handed to a reader
+    min_size (int): files smaller than this are copied with safe_copy_file,
+        unless either side has a bandwidth limit
+
+    The destination is preallocated and the source is split into
+    segment_size ranges which are copied on the shared I/O thread pool with
+    copy_file_range (or pread/pwrite where that is unavailable). The number
+    of ranges in flight adapts to the measured throughput. Each range waits
+    for the bandwidth limits of the source and destination mounts. Returns
+    0 on success like safe_copy_file. Fails if file already exists; a
+    partial destination is removed if the copy fails.
+    '''
+    if pathlib.Path(dest).exists():
+        raise FileExistsError(
+            errno.EEXIST,
+            os.strerror(errno.EEXIST),
+            dest)
+    size = os.stat(str(src)).st_size
+    buckets = get_limiter().buckets_for(src, dest)
+    if size < min_size and not any(bucket.rate for bucket in buckets):
+        return await safe_copy_file(src, dest)
+    loop = asyncio.get_event_loop()
+    tuner = _StreamTuner(streams, max_streams)
+    offsets = list(range(0, size, segment_size))
+    offsets.reverse()
+    fd_in = os.open(str(src), os.O_RDONLY)
+    try:
+        fd_out = os.open(str(dest), os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o644)
+    except BaseException:
+        os.close(fd_in)
+        raise
+    pending = set()
+    try:
+        _preallocate(fd_out, size)
+        while offsets or pending:
+            while offsets and len(pending) < tuner.streams:
+                offset = offsets.pop()
+                length = min(segment_size, size - offset)
+                await acquire(buckets, length)
+                pending.add(loop.run_in_executor(
+                    _get_io_executor(), _copy_range, fd_in, fd_out, offset,
+                    length))
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                tuner.record(fut.result())
+    except BaseException:
+        if pending:
+            await asyncio.wait(pending)
+        os.close(fd_out)
+        fd_out = None
+        _remove_partial(dest)
+        raise
+    finally:
+        os.close(fd_in)
+        if fd_out is not None:
+            os.close(fd_out)
+    logger.debug('parallel_copy_file {0} -> {1} {2} bytes, {3} streams'
+                 .format(src, dest, size, tuner.streams))
+    return 0
+
+
+async def tee_copy_file(src, dests, block_size=HASH_BLOCK_SIZE,
+                        queue_blocks=TEE_QUEUE_BLOCKS):
+    '''Async copy src to several destinations from a single read.
 
-    Creates a shasum subprocess. Returns the output of shasum as a 2-tuple
-    of bytes.
-    (b'af9fce487c7d1e5d6101d5317b9884481a874442  /path/to/file', b'')
-    First element is the stdout result of shasum, second is the stderr.
+    Parameters:
+    src (string or pathlike object): path to the source file
+    dests (list of string or pathlike object): paths to the destinations
+    block_size (int): size in bytes of each block read and written
+    queue_blocks (int): blocks a destination may fall behind the reader
+
+    The source is read once and each block is handed to one writer per
+    destination. The reader stays at most queue_blocks ahead of the slowest
+    attached writer, so a single destination is always written from the
+    one read. A writer that falls queue_blocks behind the other
+    destinations is detached so it cannot hold up the rest; it finishes by
+    reading the rest of the source itself. The last attached writer is
+    never detached. Each destination is written to a hidden partial file
+    (see partial_path), read back and compared against the source
+    tree_hash, then renamed into place.
+    Reads and writes wait for the bandwidth limit of their mount. A
+    detached writer only reads blocks the main reader has already read and
+    charged, so its reads are charged to its destination alone.
+
+    Returns a dict mapping each str(dest) to None on success or to the
+    exception that failed it. Fails for a destination that already exists.
     '''
-    cmd = ['shasum', str(path)]
-    return await _communicate_subprocess_exec(cmd)
+    loop = asyncio.get_event_loop()
+    queue_blocks = max(1, queue_blocks)
+    size = os.stat(str(src)).st_size
+    hasher = _TreeHasher(size)
+    src_buckets = get_limiter().buckets_for(src)
+    fd_in = os.open(str(src), os.O_RDONLY)
+    progress = asyncio.Event()
+    writers = {}
+    tasks = {}
+    results = {}
+    try:
+        for dest in dests:
+            try:
+                writers[str(dest)] = _TeeWriter(dest, progress)
+            except OSError as e:
+                results[str(dest)] = e
+        tasks = {name: loop.create_task(
+                     writer.run(fd_in, size, block_size))
+                 for name, writer in writers.items()}
+        offset = 0
+        while offset < size:
+            if not await _wait_for_writers(writers.values(), progress,
+                                           queue_blocks, block_size):
+                break
+            count = min(block_size, size - offset)
+            await acquire(src_buckets, count)
+            block = await loop.run_in_executor(
+                _get_io_executor(), _read_and_hash, fd_in, hasher, count,
+                offset)
+            if not block:
+                raise EOFError('Unexpected end of file at offset {0}'
+                               .format(offset))
+            for writer in writers.values():
+                writer.offer(offset, block)
+            offset += len(block)
+        for writer in writers.values():
+            writer.finish()
+        if tasks:
+            await asyncio.wait(tasks.values())
+        digest = None
+        if offset == size:
+            digest = hasher.hexdigest()
+        elif any(task.exception() is None for task in tasks.values()):
+            digest = await tree_hash(src)
+        for name, task in tasks.items():
+            results[name] = task.exception()
+            if results[name] is None:
+                results[name] = await writers[name].commit(digest)
+            else:
+                writers[name].abort()
+    except BaseException:
+        for writer in writers.values():
+            writer.stopped = True
+            writer.finish()
+        if tasks:
+            await asyncio.wait(tasks.values())
+        for writer in writers.values():
+            writer.abort()
+        raise
+    finally:
+        os.close(fd_in)
+    return results
+
+
+async def _wait_for_writers(writers, progress, queue_blocks, block_size):
+    '''Wait until every attached writer has room for another block.
+
+    A full writer that is queue_blocks behind the furthest attached writer
+    is detached, unless it is the only one left. Returns False once no
+    writer is attached, so the reader can stop.
+    '''
+    while True:
+        attached = [writer for writer in writers if writer.attached]
+        if not attached:
+            return False
+        full = [writer for writer in attached
+                if writer.queue.qsize() >= queue_blocks]
+        if not full:
+            return True
+        leader = max(writer.offset for writer in attached)
+        for writer in full:
+            if (len(attached) > 1 and
+                    leader - writer.offset >= queue_blocks * block_size):
+                writer.detach()
+                attached.remove(writer)
+        if all(writer.queue.qsize() < queue_blocks for writer in attached):
+            continue
+        progress.clear()
+        await progress.wait()
+
+
+class _TeeWriter():
+    '''One destination of tee_copy_file.
+    '''
+
+    def __init__(self, dest, progress):
+        if pathlib.Path(dest).exists():
+            raise FileExistsError(
+                errno.EEXIST,
+                os.strerror(errno.EEXIST),
+                dest)
+        self.dest = pathlib.Path(dest)
+        self.part = partial_path(self.dest)
+        self.buckets = get_limiter().buckets_for(self.dest)
+        self.fd = os.open(str(self.part),
+                          os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.progress = progress
+        self.queue = asyncio.Queue()
+        self.detached = False
+        self.done = False
+        self.stopped = False
+        self.finished = False
+        self.offset = 0
+
+    @property
+    def attached(self):
+        '''True while this writer is fed by the main reader.
+        '''
+        return not (self.detached or self.done or self.finished)
+
+    def detach(self):
+        logger.info('tee_copy_file detaching slow destination {0}'
+                    .format(self.dest))
+        self.detached = True
+        self.queue.put_nowait(None)
+
+    def offer(self, offset, block):
+        if self.attached:
+            self.queue.put_nowait((offset, block))
+
+    def finish(self):
+        if not self.detached and not self.done:
+            self.queue.put_nowait(None)
+        self.done = True
+
+    async def run(self, fd_in, size, block_size):
+        loop = asyncio.get_event_loop()
+        executor = _get_io_executor()
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is None:
+                    break
+                offset, block = item
+                await acquire(self.buckets, len(block))
+                await loop.run_in_executor(
+                    executor, _pwrite_all, self.fd, block, offset)
+                self.offset = offset + len(block)
+                self.progress.set()
+            while self.offset < size and not self.stopped:
+                count = min(block_size, size - self.offset)
+                await acquire(self.buckets, count)
+                written = await loop.run_in_executor(
+                    executor, _pread_pwrite, fd_in, self.fd, count,
+                    self.offset)
+                if not written:
+                    raise EOFError('Unexpected end of file at offset {0}'
+                                   .format(self.offset))
+                self.offset += written
+            await loop.run_in_executor(executor, os.fsync, self.fd)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+            self.finished = True
+            self.progress.set()
+
+    async def commit(self, digest):
+        '''Check the written copy against the source digest and rename it.
+
+        Returns None on success or the exception describing the failure.
+        '''
+        try:
+            written = await tree_hash(self.part)
+            if written != digest:
+                raise ValueError('Digest mismatch for {0}: {1} != {2}'
+                                 .format(self.dest, written, digest))
+            os.rename(str(self.part), str(self.dest))
+        except (OSError, ValueError) as e:
+            self.abort()
+            return e
+        return None
+
+    def abort(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        _remove_partial(self.part)
+
+
+def _read_and_hash(fd, hasher, count, offset):
+    block = os.pread(fd, count, offset)
+    hasher.update(block)
+    return block
+
+
+def _pwrite_all(fd, block, offset):
+    view = memoryview(block)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+async def stage_file(src, dest, **kwargs):
+    '''Async stage src at dest as cheaply as the filesystems allow.
+
+    Parameters:
+    src (string or pathlike object): path to the source file
+    dest (string or pathlike object): path to the destination
+    **kwargs: passed on to parallel_copy_file
+
+    When src and the destination directory are on the same device, a
+    reflink (FICLONE) is tried first, then a hardlink, then an in-kernel
+    copy_file_range, which is held to the mount's bandwidth limit.
+    Otherwise, or if all of those fail, the file is copied with
+    parallel_copy_file. Returns the method used: 'reflink', 'hardlink',
+    'copy_file_range' or 'copy'. Fails if file already exists.
+
+    A hardlinked dest shares its data with src, so it must never be
+    modified in place.
+    '''
+    if pathlib.Path(dest).exists():
+        raise FileExistsError(
+            errno.EEXIST,
+            os.strerror(errno.EEXIST),
+            dest)
+    loop = asyncio.get_event_loop()
+    executor = _get_io_executor()
+    src_dev = os.stat(str(src)).st_dev
+    if src_dev == os.stat(str(pathlib.Path(dest).parent)).st_dev:
+        for method, copy in (
+                ('reflink', lambda: loop.run_in_executor(
+                    executor, _reflink, str(src), str(dest))),
+                ('hardlink', lambda: loop.run_in_executor(
+                    executor, _hardlink, str(src), str(dest))),
+                ('copy_file_range', lambda: _copy_file_range(
+                    str(src), str(dest)))):
+            try:
+                await copy()
+            except (AttributeError, OSError) as e:
+                logger.debug('stage_file {0} failed for {1}: {2}'
+                             .format(method, src, e))
+                continue
+            return method
+    ret = await parallel_copy_file(src, dest, **kwargs)
+    if ret:
+        raise CalledProcessError(ret, ['cp', str(src), str(dest)])
+    return 'copy'
+
+
+def _reflink(src, dest):
+    with open(src, mode='rb') as f_in:
+        fd_out = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(fd_out, FICLONE, f_in.fileno())
+        except BaseException:
+            os.close(fd_out)
+            _remove_partial(dest)
+            raise
+        os.close(fd_out)
+
+
+def _hardlink(src, dest):
+    os.link(src, dest)
+
+
+async def _copy_file_range(src, dest):
+    '''Async in-kernel copy, one block per I/O pool call.
+
+    Waiting for the bandwidth limit happens between blocks, on the event
+    loop, so a throttled copy does not hold a pool thread.
+    '''
+    loop = asyncio.get_event_loop()
+    executor = _get_io_executor()
+    size = os.stat(src).st_size
+    buckets = get_limiter().buckets_for(dest)
+    with open(src, mode='rb') as f_in:
+        fd_out = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            offset = 0
+            while offset < size:
+                count = min(COPY_BLOCK_SIZE, size - offset)
+                await acquire(buckets, count)
+                written = await loop.run_in_executor(
+                    executor, os.copy_file_range, f_in.fileno(), fd_out,
+                    count, offset, offset)
+                if not written:
+                    raise EOFError('Unexpected end of file at offset {0}'
+                                   .format(offset))
+                offset += written
+        except BaseException:
+            os.close(fd_out)
+            _remove_partial(dest)
+            raise
+        os.close(fd_out)
+
+
+class _StreamTuner():
+    '''Hill-climb the number of concurrent copy streams on throughput.
+
+    Once as many ranges as there are streams have completed, the throughput
+    of that window is compared with the previous one. The stream count keeps
+    moving in the same direction unless throughput drops, then reverses.
+    '''
+
+    def __init__(self, streams, max_streams, tolerance=0.05):
+        self.streams = max(1, min(streams, max_streams))
+        self.max_streams = max_streams
+        self.tolerance = tolerance
+        self.step = 1
+        self.last_rate = None
+        self._bytes = 0
+        self._count = 0
+        self._start = time.monotonic()
+
+    def record(self, nbytes):
+        self._bytes += nbytes
+        self._count += 1
+        if self._count < self.streams:
+            return
+        now = time.monotonic()
+        rate = self._bytes / max(now - self._start, 1e-6)
+        if (self.last_rate is not None and
+                rate < self.last_rate * (1 - self.tolerance)):
+            self.step = -self.step
+        streams = self.streams + self.step
+        if not 1 <= streams <= self.max_streams:
+            self.step = -self.step
+            streams = self.streams + self.step
+        self.streams = max(1, min(self.max_streams, streams))
+        self.last_rate = rate
+        self._bytes = 0
+        self._count = 0
+        self._start = now
+
+
+def _preallocate(fd, size):
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+
+def _copy_range(fd_in, fd_out, offset, length):
+    '''Copy one range between open files. Runs in the I/O thread pool.
+    '''
+    end = offset + length
+    while offset < end:
+        count = min(COPY_BLOCK_SIZE, end - offset)
+        try:
+            written = os.copy_file_range(fd_in, fd_out, count, offset, offset)
+        except (AttributeError, OSError):
+            written = _pread_pwrite(fd_in, fd_out, count, offset)
+        if not written:
+            raise EOFError('Unexpected end of file at offset {0}'
+                           .format(offset))
+        offset += written
+    return length
+
+
+def _pread_pwrite(fd_in, fd_out, count, offset):
+    block = os.pread(fd_in, count, offset)
+    view = memoryview(block)
+    while view:
+        written = os.pwrite(fd_out, view, offset)
+        view = view[written:]
+        offset += written
+    return len(block)
+
+
+def partial_path(path):
+    '''Return the hidden name a file is written under until complete.
+
+    The leading dot and .part suffix keep it out of Scipion's filesPattern
+    and out of the Globus sync of storage_root, so neither ever sees a
+    partially written file.
+    '''
+    path = pathlib.Path(path)
+    return path.with_name('.' + path.name + '.part')
 
 
-async def compare_hashes(path_a, path_b):
+def _remove_partial(path):
+    try:
+        os.remove(str(path))
+    except OSError:
+        pass
+
+
+async def compare_hashes(path_a, path_b, digest_file=None):
     '''Compare the hashes of two files.
 
     Parameters:
     path_a, path_b (string or pathlike object): the paths to the files to hash
         and compare.
+    digest_file (string or pathlike object): if given and the hashes match,
+        the digest is written here as a 'DIGEST  NAME' line for path_a
+
+    Both files are hashed at the same time with tree_hash. Raises
+    FileNotFoundError if either file does not exist.
+    '''
+    a, b = await asyncio.gather(tree_hash(path_a), tree_hash(path_b))
+    logger.debug('compare_hashes {0} {1}, {2} {3}'
+                 .format(path_a, a, path_b, b))
+    if a == b and digest_file is not None:
+        write_digest(digest_file, a, pathlib.Path(path_a).name)
+    return a == b
+
+
+def write_digest(path, digest, name):
+    '''Atomically write a 'DIGEST  NAME' line to path and log it.
+    '''
+    part = partial_path(path)
+    part.write_text('{0}  {1}\n'.format(digest, name), encoding='utf8')
+    os.rename(str(part), str(path))
+    logger.info('Digest of {0}: {1}'.format(name, digest))
+
+
+async def tree_hash(path, chunk_size=HASH_CHUNK_SIZE):
+    '''Async hash the file in-process as a BLAKE2b tree.
+
+    Parameters:
+    path (string or pathlike object): the path to the file to hash
+    chunk_size (int): leaf size in bytes; a multiple of HASH_BLOCK_SIZE
+
+    The file is split into chunk_size leaves which are read and hashed in
+    parallel on the shared I/O thread pool, then combined into a root node
+    using the BLAKE2b tree parameters (fanout 0, depth 2). Returns a string
+    of the form HASH_FORMAT, e.g.
+        'blake2b-tree:67108864:9f3c...'
+    The leaf size is part of the digest, so digests from hosts using the same
+    chunk_size are directly comparable. Each leaf waits for the bandwidth
+    limit of the file's mount before it is read.
+    '''
+    loop = asyncio.get_event_loop()
+    size = os.stat(str(path)).st_size
+    count = max(1, -(-size // chunk_size))
+    buckets = get_limiter().buckets_for(path)
+
+    async def leaf(index):
+        await acquire(buckets, min(chunk_size, size - index * chunk_size))
+        return await loop.run_in_executor(
+            _get_io_executor(), _hash_leaf, fd, index, count, chunk_size)
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        leaves = await asyncio.gather(*[leaf(index)
+                                        for index in range(count)])
+    finally:
+        os.close(fd)
+    root = _tree_node(0, 1, True, chunk_size)
+    for leaf in leaves:
+        root.update(leaf)
+    return HASH_FORMAT.format(chunk_size=chunk_size, digest=root.hexdigest())
+
+
+class _TreeHasher():
+    '''Incremental form of tree_hash for data that arrives in order.
+
+    Produces the same digest as tree_hash for a file of `size` bytes.
+    '''
+
+    def __init__(self, size, chunk_size=HASH_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.count = max(1, -(-size // chunk_size))
+        self.leaves = []
+        self.filled = 0
+        self.node = _tree_node(0, 0, self.count == 1, chunk_size)
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            if self.filled == self.chunk_size:
+                self.leaves.append(self.node.digest())
+                index = len(self.leaves)
+                self.node = _tree_node(index, 0, index == self.count - 1,
+                                       self.chunk_size)
+                self.filled = 0
+            take = min(len(view), self.chunk_size - self.filled)
+            self.node.update(view[:take])
+            self.filled += take
+            view = view[take:]
+
+    def hexdigest(self):
+        root = _tree_node(0, 1, True, self.chunk_size)
+        for leaf in self.leaves + [self.node.digest()]:
+            root.update(leaf)
+        return HASH_FORMAT.format(chunk_size=self.chunk_size,
+                                  digest=root.hexdigest())
+
+
+def _tree_node(offset, depth, last, chunk_size):
+    return hashlib.blake2b(digest_size=HASH_DIGEST_SIZE,
+                           fanout=0,
+                           depth=2,
+                           leaf_size=chunk_size,
+                           node_offset=offset,
+                           node_depth=depth,
+                           inner_size=HASH_DIGEST_SIZE,
+                           last_node=last)
+
+
+def _hash_leaf(fd, index, count, chunk_size):
+    '''Hash one leaf of the tree. Runs in the I/O thread pool.
+    '''
+    node = _tree_node(index, 0, index == count - 1, chunk_size)
+    offset = index * chunk_size
+    end = offset + chunk_size
+    while offset < end:
+        block = os.pread(fd, min(HASH_BLOCK_SIZE, end - offset), offset)
+        if not block:
+            break
+        node.update(block)
+        offset += len(block)
+    return node.digest()
+
+
+def _get_io_executor():
+    '''Return the thread pool shared by the in-process I/O functions.
     '''
-    a = await file_hash(path_a)
-    b = await file_hash(path_b)
-    if a[0] and b[0]:
-        return a[0].split()[0] == b[0].split()[0]
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS)
+    return _io_executor
+
+
+async def probe_compressibility(path, blocks=PROBE_BLOCKS,
+                                block_size=PROBE_BLOCK_SIZE):
+    '''Estimate how well a file compresses from a sample of its blocks.
+
+    Parameters:
+    path (string or pathlike object): the path to the file to probe
+    blocks (int): number of blocks to sample, spread evenly over the file
+    block_size (int): size in bytes of each sampled block
+
+    Each block is compressed with fast zlib as a stand-in for lbzip2. Returns
+    the compressed/original size ratio of the sample; values near 1.0 mean
+    the file is already compressed (LZW/zip TIFF, EER). An empty file
+    returns 1.0.
+    '''
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        _get_io_executor(), _probe_compressibility, str(path), blocks,
+        block_size)
+
+
+def _probe_compressibility(path, blocks, block_size):
+    size = os.stat(path).st_size
+    if size <= blocks * block_size:
+        offsets = range(0, size, block_size)
     else:
-        raise FileNotFoundError(
-            errno.ENOENT,
-            os.strerror(errno.ENOENT),
-            (a, b)
-        )
+        step = (size - block_size) // (blocks - 1) if blocks > 1 else 0
+        offsets = [i * step for i in range(blocks)]
+    raw = compressed = 0
+    with open(path, mode='rb') as f:
+        for offset in offsets:
+            f.seek(offset)
+            block = f.read(block_size)
+            raw += len(block)
+            compressed += len(zlib.compress(block, 1))
+    return compressed / raw if raw else 1.0
 
 
 async def compress_file(path, force=False):
@@ -76,14 +725,24 @@ async def compress_file(path, force=False):
     return await _wait_subprocess_exec(cmd)
 
 
-async def uncompress_file(path, force=False):
+async def uncompress_file(path, force=False, dest=None):
     '''Uncompress the file using lbzip2. Returns only after uncompress complete.
 
+    Parameters:
+    path (string or pathlib.Path): path of file to uncompress
+    force (bool): overwrite existing files (default False)
+    dest (string or pathlib.Path): write the uncompressed data here instead
+        of next to path with the .bz2 suffix removed
+
     Defaults are set for the ATC linux box to not saturate.
     '''
-    cmd = ['lbzip2', '-k', '-n 4', '-d', str(path)]
-    cmd.insert(1, '-f') if force else None
-    return await _wait_subprocess_exec(cmd)
+    if dest is None:
+        cmd = ['lbzip2', '-k', '-n 4', '-d', str(path)]
+        cmd.insert(1, '-f') if force else None
+        return await _wait_subprocess_exec(cmd)
+    cmd = ['lbzip2', '-n 4', '-d', '-c', str(path)]
+    with open(str(dest), mode='wb' if force else 'xb') as out:
+        return await _wait_subprocess_exec(cmd, stdout=out)
 
 
 async def convert_to_mrc(src, dest):
@@ -118,9 +777,33 @@ async def globus_transfer(src_endpoint_spec, dest_endpoint_spec, *args):
         'globus transfer -s mtime src dest' must be passed as
         globus_transfer(src, dest, '-s', 'mtime')
     The transfer command will error if options are combined with arguments
+
+    Returns the id of the submitted transfer task; the transfer itself runs
+    on after this returns (see globus_task_status).
+
+    Raises subprocess.CalledProcessError if the process outputs stderr
     '''
-    cmd = ['globus', 'transfer', src_endpoint_spec, dest_endpoint_spec, *args]
-    return await _wait_subprocess_exec(cmd)
+    cmd = ['globus', 'transfer', '--format', 'unix', '--jmespath', 'task_id',
+           src_endpoint_spec, dest_endpoint_spec, *args]
+    stdout, stderr = await _communicate_subprocess_exec(cmd)
+    if stderr:
+        raise CalledProcessError(2, cmd, output=stdout, stderr=stderr)
+    return stdout.decode('utf8').strip()
+
+
+async def globus_task_status(task_id):
+    '''Check the status of a globus task.
+
+    Returns one of 'ACTIVE', 'INACTIVE', 'SUCCEEDED' or 'FAILED'.
+
+    Raises subprocess.CalledProcessError if the process outputs stderr
+    '''
+    cmd = ['globus', 'task', 'show', '--format', 'unix', '--jmespath',
+           'status', task_id]
+    stdout, stderr = await _communicate_subprocess_exec(cmd)
+    if stderr:
+        raise CalledProcessError(2, cmd, output=stdout, stderr=stderr)
+    return stdout.decode('utf8').strip()
 
 
 async def globus_endpoint_get_remaining_activation(endpoint):
@@ -161,9 +844,9 @@ async def start_scipion_project(project_name):
     return await _communicate_subprocess_exec(cmd)
 
 
-async def _wait_subprocess_exec(cmd):
+async def _wait_subprocess_exec(cmd, stdout=None):
     logger.debug('_wait_subprocess_exec starting {0}'.format(cmd))
-    process = await asyncio.create_subprocess_exec(*cmd)
+    process = await asyncio.create_subprocess_exec(*cmd, stdout=stdout)
     ret = await process.wait()
     if ret:
         logger.warning('_wait_subprocess_exec error {0} with cmd {1}'
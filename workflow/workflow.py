@@ -1,84 +1,297 @@
+from collections import deque
+from collections.abc import MutableMapping
 from transitions import Machine
+from workflow.container import CONTAINER_SUFFIX, pack_files, verify_container
 from workflow.monitor import FilePatternMonitor
-from workflow.utilities import (safe_copy_file, compare_hashes, compress_file,
+from workflow.scheduler import StageScheduler, HIGH, LOW
+from workflow.scipion import STACK_SUFFIX
+from workflow.scratch import ScratchVolumes
+from workflow.status import PipelineStats, StatusServer, BacklogProgress
+from workflow.utilities import (compare_hashes, compress_file,
                                 uncompress_file, stack_files, globus_transfer,
+                                globus_task_status,
                                 create_scipion_project, start_scipion_project,
-                                convert_to_mrc)
+                                convert_to_mrc, stage_file, tee_copy_file,
+                                probe_compressibility, DIGEST_SUFFIX)
 import asyncio
+import functools
+import itertools
 import logging
 import os
 import pathlib
+import subprocess
+import sys
 import time
+import weakref
 
 GLOBUS_ROOT = '/mnt/NCEF-CryoEM/'
 ATC_GLOBUS_ENDPOINT = '67dace28-311f-11e8-b8f8-0ac6873fc732'
 MOAB_GLOBUS_ENDPOINT = 'dabdccc3-6d04-11e5-ba46-22000b92c6ec'
+SCIPION_WEB_ROOT = '/var/www/scipion/'
+SCIPION_PROJECTS = os.path.join(
+    os.environ.get('SCIPION_USER_DATA',
+                   os.path.expanduser('~/ScipionUserData')),
+    'projects')
+CONVERT_SUFFIXES = ('.dm4',)
 logger = logging.getLogger(__name__)
 
 
 class Project():
     '''Overarching project controller
     '''
+    BACKLOG_REPORT_INTERVAL = 60
+    BACKLOG_ADMIT_INTERVAL = 5
+    BACKLOG_MAX_ITEMS = 32
+    BACKLOG_MAX_BYTES = 64 * 1024 * 1024 * 1024
+    SCIPION_ATTEMPTS = 3
+    SCIPION_HEALTH_TIMEOUT = 600
+    SCIPION_HEALTH_INTERVAL = 5
+    SCIPION_RETRY_DELAY = 30
+    PACK_TARGET_SIZE = 4 * 1024 * 1024 * 1024
+    PACK_MAX_WAIT = 300
+    GLOBUS_POLL_INTERVAL = 60
+    SCRATCH_SAMPLE_INTERVAL = 10
+    GLOBUS_DONE_STATUSES = ('SUCCEEDED', 'FAILED')
 
     def __init__(self, project, pattern, frames=1, scipion_config=None,
-                 globus_root=None):
+                 globus_root=None, status_address=None, scratch_roots=None,
+                 export_roots=None, pack_below=0):
         self.project = project
         self.workflow = Workflow()
         self.awh = AsyncWorkflowHelper()
         self.monitor = FilePatternMonitor(pattern, recursive=True)
+        self.stats = PipelineStats()
+        self.backlog = None
+        self._backlog_paths = deque()
+        self.scipion_state = None
+        self.globus_status = {'last_submit': None, 'task_id': None,
+                              'status': None}
+        self.path_table = PathTable()
+        self.pack_below = pack_below
+        self.packing = []
+        self._packing_size = 0
+        self._packing_since = None
+        self._container_count = itertools.count()
+        self.status = (StatusServer(self, status_address)
+                       if status_address else None)
         if globus_root is None:
             globus_root = GLOBUS_ROOT
+        if not scratch_roots:
+            scratch_roots = ['/tmp']
         self.paths = {
                 'local_root': '/tmp/' + str(project),
+                'scratch_roots': [str(pathlib.Path(root, str(project)))
+                                  for root in scratch_roots],
                 'storage_root': '/mnt/nas/' + str(project),
                 'globus_root': globus_root.rstrip('/') + '/' + str(project),
                 'scipion_config': scipion_config
                 }
+        self.paths['export_roots'] = [self.paths['storage_root'], *[
+            str(pathlib.Path(root, str(project)))
+            for root in export_roots or []]]
+        self.scratch = ScratchVolumes(self.paths['scratch_roots'])
         self._ensure_root_directories()
         self.frames = frames
         if self.frames > 1:
-            self._ensure_directory(str(
-                pathlib.Path(self.paths['local_root']).joinpath(
-                    pathlib.Path('stack'))))
+            for root in [self.paths['local_root'],
+                         *self.paths['scratch_roots']]:
+                self._ensure_directory(str(
+                    pathlib.Path(root).joinpath(pathlib.Path('stack'))))
         self.workflow.MIN_IMPORT_INTERVAL = \
             self.workflow.MIN_IMPORT_INTERVAL / self.frames
 
     def start(self):
+        if self.status:
+            self.awh.loop.run_until_complete(self.status.start())
         self._transfer_loop()
-        self.awh.add_timed_callback(self._start_scipion, 60)
+        self._sample_scratch()
         self.awh.loop.run_until_complete(self._async_start())
 
     async def _async_start(self):
         try:
+            self._admit_backlog(await self.monitor)
             while True:
                 items = await self.monitor
                 for item in items:
-                    model = WorkflowItem(item, self.workflow, self)
-                    self.workflow.add_model(model)
-                    model.initialize()
+                    self._admit(item)
                     await asyncio.sleep(self.workflow.MIN_IMPORT_INTERVAL)
                 await asyncio.sleep(2)
         except StopAsyncIteration:
             import sys
             sys.exit(0)
 
+    def _admit(self, path, backlog=False):
+        model = WorkflowItem(path, self.workflow, self, backlog=backlog)
+        self.workflow.add_model(model)
+        model.initialize()
+        return model
+
+    def _admit_backlog(self, paths):
+        '''Admit the files that already exist at startup, oldest first.
+
+        Files are admitted without the live-acquisition MIN_IMPORT_INTERVAL
+        pacing, but only while fewer than BACKLOG_MAX_ITEMS movies' worth
+        of them are unfinished and less than BACKLOG_MAX_BYTES of scratch
+        is reserved, so the backlog cannot fill the scratch volumes. In
+        frames mode a frame is not finished until its whole stack is, so
+        the frames of each movie are admitted together. Progress is logged
+        until the backlog is done.
+        '''
+        if not paths:
+            return
+        logger.info('Catching up on {0} existing files'.format(len(paths)))
+        movies = {}
+        for path in sorted(paths, key=self._mtime):
+            movies.setdefault(self._movie_of(path), []).append(path)
+        self._backlog_paths = deque(movies.values())
+        self.backlog = BacklogProgress([], total=len(paths))
+        self._admit_backlog_batch()
+        self.awh.add_timed_callback(self._report_backlog,
+                                    self.BACKLOG_REPORT_INTERVAL)
+
+    def _movie_of(self, path):
+        '''Return the name of the movie a file is, or is a frame of.
+        '''
+        path = pathlib.Path(path)
+        return path.stem[:-2] if self.frames > 1 else path.name
+
+    def _admit_backlog_batch(self):
+        while self._backlog_paths:
+            in_flight = self.backlog.in_flight
+            if in_flight and (
+                    in_flight >= self.BACKLOG_MAX_ITEMS * self.frames or
+                    self.scratch.in_flight >= self.BACKLOG_MAX_BYTES):
+                break
+            for path in self._backlog_paths.popleft():
+                self.backlog.add(self._admit(path, backlog=True))
+        if self._backlog_paths:
+            self.awh.add_timed_callback(self._admit_backlog_batch,
+                                        self.BACKLOG_ADMIT_INTERVAL)
+
+    def _report_backlog(self):
+        self.backlog.log()
+        if self.backlog.complete:
+            logger.info('Backlog complete')
+        else:
+            self.awh.add_timed_callback(self._report_backlog,
+                                        self.BACKLOG_REPORT_INTERVAL)
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(str(path)).st_mtime
+        except FileNotFoundError:
+            return 0
+
+    def notify_scipion_input(self):
+        '''Launch Scipion when the first input file is handed off to it.
+        '''
+        if self.scipion_state is None:
+            self._start_scipion()
+
     def _start_scipion(self):
         if not self.paths['scipion_config']:
             logger.info('Not starting Scipion, no config file found')
+            self.scipion_state = 'disabled'
             return None
         else:
             logger.info('Starting Scipion for {0}'.format(self.project))
-        self.awh.create_task(
-            create_scipion_project(self.project,
-                                   self.paths['scipion_config']),
-            done_cb=self._schedule_scipion_project)
+        self.scipion_state = 'starting'
+        self.awh.create_task(self._launch_scipion(),
+                             done_cb=self._scipion_launched)
+
+    async def _launch_scipion(self):
+        '''Create and schedule the Scipion project, checking each step.
 
-    def _schedule_scipion_project(self, fut=None):
+        Creation is checked by the project directory appearing under
+        SCIPION_PROJECTS, scheduling by the project's status page appearing
+        under SCIPION_WEB_ROOT within SCIPION_HEALTH_TIMEOUT seconds. Failed
+        steps are retried with a growing delay, up to SCIPION_ATTEMPTS times.
+        The status page is still watched during the delay, so a slow start
+        is not started a second time once it comes up.
+        '''
+        project_dir = pathlib.Path(SCIPION_PROJECTS, str(self.project))
+        index = pathlib.Path(SCIPION_WEB_ROOT, str(self.project),
+                             'index.html')
+        for attempt in range(1, self.SCIPION_ATTEMPTS + 1):
+            if not project_dir.exists():
+                await create_scipion_project(self.project,
+                                             self.paths['scipion_config'])
+            if project_dir.exists():
+                await start_scipion_project(self.project)
+                if await self._wait_for_file(index,
+                                             self.SCIPION_HEALTH_TIMEOUT):
+                    return attempt
+            logger.warning('Scipion not running for {0} after attempt {1}'
+                           .format(self.project, attempt))
+            if await self._wait_for_file(
+                    index, self.SCIPION_RETRY_DELAY * attempt):
+                return attempt
+        raise RuntimeError('Scipion failed to start after {0} attempts'
+                           .format(self.SCIPION_ATTEMPTS))
+
+    async def _wait_for_file(self, path, timeout):
+        '''Return True once path exists, or False after timeout seconds.
+        '''
+        waited = 0
+        while waited < timeout:
+            if path.exists():
+                return True
+            await asyncio.sleep(self.SCIPION_HEALTH_INTERVAL)
+            waited += self.SCIPION_HEALTH_INTERVAL
+        return path.exists()
+
+    def _scipion_launched(self, fut):
         if fut.exception():
-            logger.warning('Could not create scipion project. {0}'
-                           .format(fut.exception()))
+            self.scipion_state = 'failed'
+            logger.error('Could not start scipion project. {0}'
+                         .format(fut.exception()))
+        else:
+            self.scipion_state = 'running'
+            logger.info('Scipion running for {0}'.format(self.project))
+
+    def pack(self, item):
+        '''Queue an item for the open container, writing it out when full.
+
+        A container is written once PACK_TARGET_SIZE bytes are queued, or
+        PACK_MAX_WAIT seconds after its first item, whichever comes first.
+        '''
+        if not self.packing:
+            self._packing_since = time.monotonic()
+            self.awh.add_timed_callback(self._pack_timeout,
+                                        self.PACK_MAX_WAIT)
+        self.packing.append(item)
+        self._packing_size += os.stat(str(item.files['local_stack'])).st_size
+        if self._packing_size >= self.PACK_TARGET_SIZE:
+            self._flush_container()
+
+    def _pack_timeout(self):
+        if not self.packing:
+            return
+        waited = time.monotonic() - self._packing_since
+        if waited >= self.PACK_MAX_WAIT:
+            self._flush_container()
         else:
-            self.awh.create_task(start_scipion_project(self.project))
+            self.awh.add_timed_callback(self._pack_timeout,
+                                        self.PACK_MAX_WAIT - waited)
+
+    def _flush_container(self):
+        members, self.packing = self.packing, []
+        size, self._packing_size = self._packing_size, 0
+        name = '{0}-{1}-{2:04d}{3}'.format(
+            self.project, time.strftime('%Y%m%d-%H%M%S'),
+            next(self._container_count), CONTAINER_SUFFIX)
+        model = ContainerItem(pathlib.Path(self.paths['local_root'], name),
+                              self.workflow, self, members, size)
+        self.workflow.add_model(model, initial='compressing')
+        model.compress()
+
+    def _sample_scratch(self):
+        '''Update the scratch volumes' throughput every few seconds.
+        '''
+        self.scratch.sample()
+        self.awh.add_timed_callback(self._sample_scratch,
+                                    self.SCRATCH_SAMPLE_INTERVAL)
 
     def _transfer_loop(self, fut=None):
         self.awh.create_task(
@@ -91,22 +304,54 @@ class Project():
 
         Default pre_wait (seconds) is 1800. Decrease to 0 for one-offs or if
         you're handling an inter-call interval yourself.
+
+        The submitted task is then followed with globus task show until it
+        succeeds or fails, so globus_status reports the transfer's own
+        status, and the next transfer is not submitted while one is running.
         '''
         if not self.project:
             raise KeyError('Project name must not be empty.')
         await asyncio.sleep(pre_wait)
-        await globus_transfer(
-            ATC_GLOBUS_ENDPOINT + ':/' + str(self.project),
-            MOAB_GLOBUS_ENDPOINT + ':' + self.paths['globus_root'],
-            '-s', 'mtime',
-            '-r',
-            '--preserve-mtime',
-            '--notify', 'failed,inactive',
-            '--label', str(self.project))
+        self.globus_status.update(last_submit=time.time(), task_id=None,
+                                  status=None)
+        try:
+            task_id = await globus_transfer(
+                ATC_GLOBUS_ENDPOINT + ':/' + str(self.project),
+                MOAB_GLOBUS_ENDPOINT + ':' + self.paths['globus_root'],
+                '-s', 'mtime',
+                '-r',
+                '--preserve-mtime',
+                '--notify', 'failed,inactive',
+                '--label', str(self.project))
+        except subprocess.CalledProcessError as e:
+            self.globus_status['status'] = 'SUBMIT_FAILED'
+            logger.warning('Globus transfer not submitted: {0}'.format(
+                e.stderr))
+            return None
+        self.globus_status['task_id'] = task_id
+        return await self._watch_globus_task(task_id)
+
+    async def _watch_globus_task(self, task_id):
+        while True:
+            try:
+                status = await globus_task_status(task_id)
+            except subprocess.CalledProcessError as e:
+                logger.warning('Could not check globus task {0}: {1}'
+                               .format(task_id, e.stderr))
+            else:
+                self.globus_status['status'] = status
+                if status in self.GLOBUS_DONE_STATUSES:
+                    logger.info('Globus task {0} {1}'.format(
+                        task_id, status.lower()))
+                    return status
+            await asyncio.sleep(self.GLOBUS_POLL_INTERVAL)
 
     def _ensure_root_directories(self):
         self._ensure_directory(self.paths['local_root'])
-        self._ensure_directory(self.paths['storage_root'])
+        for root in self.paths['scratch_roots']:
+            self._ensure_directory(root)
+        for root in self.paths['export_roots']:
+            self._ensure_directory(root)
 
     @staticmethod
     def _ensure_directory(path):
@@ -118,10 +363,17 @@ class Project():
 
 class Workflow(Machine):
     '''The workflow state machine.
+
+    transitions binds a partial to every model for each trigger and state.
+    Models whose class uses __slots__, like WorkflowItem, instead share
+    class-level dispatchers installed once per class by add_model.
     '''
     MIN_IMPORT_INTERVAL = 45
 
     def __init__(self):
+        self._shared_classes = set()
+        self._by_original = {}
+        self._table = None
         states = ['initial',
                   'creating',
                   'importing',
@@ -149,51 +401,292 @@ class Workflow(Machine):
                                     'converting'],
                             dest='compressing')
         self.add_transition('export',
-                            source=['compressing', 'exporting'],
+                            source=['importing', 'converting', 'stacking',
+                                    'compressing', 'exporting'],
                             dest='exporting')
         self.add_transition('convert_to_mrc',
                             source=['converting', 'importing'],
                             dest='converting')
-        self.add_transition('hold_for_processing',
-                            source=['exporting', 'processing'],
-                            dest='processing')
         self.add_transition('confirm',
-                            source=['processing', 'exporting'],
+                            source=['exporting', 'confirming'],
                             dest='confirming')
+        self.add_transition('hold_for_processing',
+                            source=['confirming', 'processing'],
+                            dest='processing')
         self.add_transition('clean',
-                            source=['stacking', 'confirming'],
+                            source=['stacking', 'processing'],
                             dest='cleaning')
         self.add_transition('finalize', source='cleaning', dest='finished')
 
-    def get_model(self, key):
-        models = [model for model in self.models[1:]
-                  if model.files['original'] == key]
-        if models:
-            return models[0]
+    def add_model(self, model, initial=None):
+        '''Register models with the machine.
+
+        Models without a __dict__ get the shared dispatchers on their class
+        and are appended without transitions' check against every model
+        already registered, which is quadratic over a long session. Other
+        models are registered by transitions as usual.
+        '''
+        models = model if isinstance(model, list) else [model]
+        bound = [mod for mod in models
+                 if isinstance(mod, str) or hasattr(mod, '__dict__')]
+        if bound:
+            Machine.add_model(self, bound, initial)
+        for mod in models:
+            self._index_original(mod)
+            if isinstance(mod, str) or hasattr(mod, '__dict__'):
+                continue
+            self._share_with_class(type(mod))
+            self.set_state(initial or self.initial, model=mod)
+            self.models.append(mod)
+
+    def _index_original(self, model):
+        files = getattr(model, 'files', None)
+        entry = getattr(files, 'entries', {}).get('original')
+        if entry is not None:
+            self._table = files.table
+            self._by_original.setdefault(entry, model)
+
+    def _share_with_class(self, cls):
+        if cls in self._shared_classes:
+            return
+        if not hasattr(cls, 'trigger'):
+            cls.trigger = _trigger_by_name
+        for trigger in self.events:
+            self._add_trigger_to_class(trigger, cls)
+        for state in self.states.values():
+            if not isinstance(getattr(cls, 'is_' + state.name, None),
+                              _SharedStateCheck):
+                setattr(cls, 'is_' + state.name, _SharedStateCheck(state.name))
+            for callback in self.state_cls.dynamic_methods:
+                method = '{0}_{1}'.format(callback, state.name)
+                if (callable(getattr(cls, method, None)) and
+                        method not in getattr(state, callback)):
+                    state.add_callback(callback[3:], method)
+        self._shared_classes.add(cls)
+
+    def _add_trigger_to_model(self, trigger, model):
+        if hasattr(model, '__dict__'):
+            Machine._add_trigger_to_model(self, trigger, model)
         else:
-            raise KeyError
+            self._add_trigger_to_class(trigger, type(model))
+
+    @staticmethod
+    def _add_trigger_to_class(trigger, cls):
+        if not isinstance(getattr(cls, trigger, None), _SharedTrigger):
+            setattr(cls, trigger, _SharedTrigger(trigger))
+
+    def get_model(self, key):
+        '''Return the item whose original path is key.
+
+        Items are indexed by their original path as they are added, so the
+        lookup does not grow with the number of items.
+        '''
+        entry = self._table.find(key) if self._table else None
+        try:
+            return self._by_original[entry]
+        except KeyError:
+            raise KeyError(key) from None
+
+
+class _SharedTrigger():
+    '''A trigger shared by every model of a class.
+
+    Fires the event on the workflow the model belongs to.
+    '''
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, model, owner=None):
+        if model is None:
+            return self
+        return functools.partial(model.workflow.events[self.name].trigger,
+                                 model)
+
+
+class _SharedStateCheck():
+    '''An is_<state> check shared by every model of a class.
+    '''
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, model, owner=None):
+        if model is None:
+            return self
+        return functools.partial(model.workflow.is_state, self.name, model)
+
+
+def _trigger_by_name(model, trigger_name, *args, **kwargs):
+    return getattr(model, trigger_name)(*args, **kwargs)
+
+
+class PathTable():
+    '''Directories interned once for all of a project's items.
+
+    A path is stored as a (directory index, file name) pair. Every item in
+    the same directory under a project root shares the directory, and names
+    are interned, so an item's original, local copy and stack usually share
+    one string too.
+    '''
+
+    def __init__(self):
+        self.directories = []
+        self._index = {}
+
+    def split(self, path):
+        directory, name = os.path.split(str(path))
+        index = self._index.get(directory)
+        if index is None:
+            index = self._index[directory] = len(self.directories)
+            self.directories.append(directory)
+        return index, sys.intern(name)
+
+    def find(self, path):
+        '''Return the entry for path, or None if its directory is unknown.
+        '''
+        directory, name = os.path.split(str(path))
+        index = self._index.get(directory)
+        return None if index is None else (index, name)
+
+    def join(self, entry):
+        return pathlib.Path(self.directories[entry[0]], entry[1])
+
+
+class ItemFiles(MutableMapping):
+    '''An item's named paths, stored as PathTable entries.
+
+    Behaves like a dict of pathlib.Path; each path is rebuilt on access.
+    '''
+    __slots__ = ('table', 'entries')
+
+    def __init__(self, table, **paths):
+        self.table = table
+        self.entries = {}
+        self.update(paths)
+
+    def __getitem__(self, key):
+        return self.table.join(self.entries[key])
+
+    def __setitem__(self, key, path):
+        self.entries[key] = self.table.split(path)
+
+    def __delitem__(self, key):
+        del self.entries[key]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
 
 
 class WorkflowItem():
     '''A file that will join and proceed through the workflow.
+
+    Long frames-mode sessions create hundreds of thousands of items, so
+    items are slotted, keep their paths in an ItemFiles and share their
+    triggers through the class (see Workflow.add_model).
     '''
+    __slots__ = ('files', 'project', 'workflow', 'state', 'unstacked',
+                 'processed', 'compressed', 'packed', 'volume', 'reserved',
+                 'import_method', 'export_pending', 'original_stat',
+                 'mtime', 'size', 'backlog', '_watching_processing')
+    COMPRESS_MIN_RATIO = 0.9
 
-    def __init__(self, path, workflow, project):
-        self.history = []
-        self.files = {'original': pathlib.Path(path)}
+    def __init__(self, path, workflow, project, backlog=False):
+        self.files = ItemFiles(project.path_table, original=path)
         self.project = project
         self.workflow = workflow
-        self.awh = project.awh
+        self.backlog = backlog
+        self.unstacked = None
+        self.processed = False
+        self.compressed = True
+        self.packed = False
+        self.volume = None
+        self.reserved = 0
+        self.import_method = None
+        self.export_pending = None
+        self.original_stat = None
+        self._watching_processing = False
+        try:
+            stat = os.stat(str(path))
+            self.mtime, self.size = stat.st_mtime, stat.st_size
+        except FileNotFoundError:
+            self.mtime, self.size = time.time(), 0
         logger.info('Starting: {0}'.format(self.files['original']))
 
+    @property
+    def awh(self):
+        return self.project.awh
+
     def _delta_mtime(self, path):
         '''Return the difference between system time and file modified timestamp
         '''
         return int(time.time()) - os.stat(str(path)).st_mtime
 
+    def _schedule(self, coro, done_cb, priority):
+        '''Queue a stage coroutine with the project's stage scheduler.
+
+        Live HIGH work runs newest file first so Scipion sees the latest
+        exposure as soon as possible. Backlog HIGH work and all LOW work run
+        oldest file first; negative keys put live HIGH work ahead of the
+        backlog.
+        '''
+        self.awh.schedule(coro, done_cb, priority,
+                          self.mtime if self.backlog or priority == LOW
+                          else -self.mtime)
+
+    def _place(self, nbytes):
+        '''Return this item's scratch directory, choosing one on first use.
+
+        The item is placed on the least-loaded scratch volume, and all of its
+        local files are kept there until it is finished.
+        '''
+        if self.volume is None:
+            self.volume = self.project.scratch.select(nbytes)
+            self.reserved = nbytes
+        return pathlib.Path(self.volume.root)
+
+    @staticmethod
+    def _partial_path(path):
+        '''Return the hidden name a file is written under until complete.
+
+        The leading dot and .part suffix keep it out of Scipion's
+        filesPattern, so Scipion never sees a partially written input.
+        '''
+        return path.with_name('.' + path.name + '.part')
+
+    def _hand_off(self, path, scipion_input=False):
+        '''Atomically rename a completed file into place.
+
+        For Scipion inputs, also make the file visible in the flat
+        local_root view and let the project know Scipion has work. With
+        several scratch volumes, local_root holds symlinks to the files on
+        each volume; with one, the volume is local_root and the rename alone
+        publishes the file.
+        '''
+        os.rename(str(self._partial_path(path)), str(path))
+        if not scipion_input:
+            return
+        view = pathlib.Path(self.project.paths['local_root'],
+                            path.relative_to(self.volume.root))
+        if view != path:
+            try:
+                os.symlink(str(path), str(view))
+            except FileExistsError:
+                pass
+            self.files['local_view'] = view
+        self.project.notify_scipion_input()
+
     def _is_processing_complete(self, path):
         project_index = pathlib.Path(
-            '/var/www/scipion/',
+            SCIPION_WEB_ROOT,
             self.project.project,
             'index.html')
         try:
@@ -218,92 +711,159 @@ class WorkflowItem():
 
     def on_enter_importing(self):
         '''Copy (import) the file to local storage for processing.
+
+        If the source is on the same filesystem as the scratch volume, the
+        file is reflinked or hardlinked instead of copied. Otherwise large
+        files are fetched with several concurrent ranged readers, small ones
+        with a single cp stream.
         '''
-        self.files['local_original'] = pathlib.Path(
-                self.project.paths['local_root'],
+        self.files['local_original'] = self._place(self.size).joinpath(
                 self.files['original'].name)
-        self.awh.create_task(
-            safe_copy_file(self.files['original'],
-                           self.files['local_original']),
-            self._importing_complete)
+        partial = self._partial_path(self.files['local_original'])
+        self._remove_file(partial)
+        self._schedule(
+            stage_file(self.files['original'], partial),
+            self._importing_complete, HIGH)
 
     def _importing_complete(self, fut):
-        if fut.exception():
+        direct = (self.project.frames == 1 and
+                  self.files['original'].suffix not in CONVERT_SUFFIXES)
+        try:
+            self.import_method = fut.result()
+            self._hand_off(self.files['local_original'], direct)
+        except Exception as e:
+            logger.warning('Import failed for {0}: {1}'.format(
+                self.files['original'], e))
             self.awh.add_timed_callback(self.import_file, 10)
-        elif fut.result() == 0:
-            if self.project.frames > 1:
-                self.stack()
-            elif self.files['original'].suffix == '.dm4':
-                self.convert_to_mrc()
-            else:
-                self.files['local_stack'] = self.files['local_original']
-                self.compress()
+            return
+        self.original_stat = self._stat_key(self.files['original'])
+        logger.info('Imported {0} by {1}'.format(
+            self.files['original'], self.import_method))
+        if self.project.frames > 1:
+            self.stack()
+        elif not direct:
+            self.convert_to_mrc()
         else:
-            self.awh.add_timed_callback(self.import_file, 10)
+            self.files['local_stack'] = self.files['local_original']
+            self._archive()
 
     def on_enter_converting(self):
         self.files['local_converted'] = \
             self.files['local_original'].with_suffix('.mrc')
-        self.awh.create_task(
+        self._schedule(
             convert_to_mrc(self.files['local_original'],
-                           self.files['local_converted']),
-            self._converting_complete)
+                           self._partial_path(self.files['local_converted'])),
+            self._converting_complete, HIGH)
 
     def _converting_complete(self, fut):
-        if fut.exception():
+        try:
+            fut.result()
+            self._hand_off(self.files['local_converted'], True)
+        except Exception as e:
+            logger.warning('Conversion failed for {0}: {1}'.format(
+                self.files['local_original'], e))
             self.awh.add_timed_callback(self.convert_to_mrc, 10)
         else:
             self.files['local_stack'] = self.files['local_original']
-            self.compress()
+            self._archive()
 
     def on_enter_stacking(self):
         '''Stack the files if the stack parameter evaluates True.
 
         If the file is an unstacked frame, check to see if there is a workflow
         item for the stack created. If there's already a workflow item,
-        reference this file in that item's self.files['local_unstacked'].
+        reference this file in that item's unstacked list.
 
         If the file is a stacked movie placeholder, call out and back until
         all of the frames are referenced, then perform stacking. If that is
         successful, trigger clean-up for each of the frames and move to
-        compressing.
+        compressing. newstack writes MRC whatever the frames are, so stacks
+        are named with STACK_SUFFIX to match Scipion's filesPattern.
         '''
         if self.project.frames == 1:
             self.compress()
             return
-        if ('local_unstacked' in self.files and
-                len(self.files['local_unstacked']) == self.project.frames):
-            pths = [f.files['original'] for f in self.files['local_unstacked']]
-            self.awh.create_task(stack_files(pths,
-                                             self.files['original']),
-                                 done_cb=self._stacking_complete)
-        elif 'local_unstacked' not in self.files:
-            stack_key = self.files['local_original'].stem[:-2] +\
-                self.files['local_original'].suffix
-            stack_path = self.files['local_original'].parent.joinpath(
-                pathlib.Path('stack')).joinpath(
-                pathlib.Path(stack_key))
-            model = WorkflowItem(stack_path, self.workflow, self.project)
-            model.files['local_original'] = stack_path
-            model.files['local_stack'] = model.files['local_original']
+        if (self.unstacked is not None and
+                len(self.unstacked) == self.project.frames):
+            pths = [f.files['original'] for f in self.unstacked]
+            self._schedule(
+                stack_files(pths,
+                            self._partial_path(self.files['local_stack'])),
+                self._stacking_complete, HIGH)
+        elif self.unstacked is None:
+            stack_key = pathlib.Path('stack').joinpath(
+                self.files['local_original'].stem[:-2] + STACK_SUFFIX)
+            stack_path = pathlib.Path(
+                self.project.paths['local_root']).joinpath(stack_key)
             try:
                 model = self.workflow.get_model(stack_path)
             except KeyError:
+                model = WorkflowItem(stack_path, self.workflow, self.project,
+                                     backlog=self.backlog)
+                model.mtime = self.mtime
+                model.files['local_original'] = model._place(
+                    self.size * self.project.frames).joinpath(stack_key)
+                model.files['local_stack'] = model.files['local_original']
                 self.workflow.add_model(model, initial='stacking')
-            try:
-                model.files['local_unstacked'].append(self)
-            except KeyError:
-                model.files['local_unstacked'] = [self]
+            if model.unstacked is None:
+                model.unstacked = []
+            model.unstacked.append(self)
             model.stack()
         else:
             pass
             # Only stack models before hitting the frame count should get here
 
     def _stacking_complete(self, fut):
-        if not fut.exception():
+        '''Hand the stack off to Scipion, or restack if newstack failed.
+
+        stack_files does not raise when newstack fails, so a failure shows
+        up as the partial stack missing when it is renamed into place.
+        '''
+        try:
+            fut.result()
+            self._hand_off(self.files['local_stack'], True)
+        except Exception as e:
+            logger.warning('Stacking failed for {0}: {1}'.format(
+                self.files['local_stack'], e))
+            self.awh.add_timed_callback(self.stack, 10)
+        else:
+            self._archive()
+
+    def _archive(self):
+        '''Start archiving the local stack, compressing it only if worthwhile.
+
+        Already-compressed inputs (LZW/zip TIFF, EER) gain almost nothing from
+        lbzip2, so a sample of blocks is test-compressed first. Inputs above
+        COMPRESS_MIN_RATIO are exported as-is, skipping both compression and
+        the decompress-verify cycle.
+
+        Archives smaller than the project's pack_below are instead packed
+        with others into a container, which is exported and verified as one.
+
+        The local stack is the Scipion input, so this is also where watching
+        for Scipion processing to complete starts.
+        '''
+        self._watch_processing()
+        if (self.project.pack_below and
+                os.stat(str(self.files['local_stack'])).st_size <
+                self.project.pack_below):
+            self.packed = True
+            self.compressed = False
+            self.export()
+            return
+        self._schedule(probe_compressibility(self.files['local_stack']),
+                       self._probe_complete, LOW)
+
+    def _probe_complete(self, fut):
+        if fut.exception() or fut.result() < self.COMPRESS_MIN_RATIO:
+            self.compressed = True
             self.compress()
         else:
-            pass
+            logger.info('Archiving {0} uncompressed, ratio {1:.3f}'.format(
+                self.files['local_stack'], fut.result()))
+            self.compressed = False
+            self.files['local_compressed'] = self.files['local_stack']
+            self.export()
 
     def on_enter_compressing(self):
         '''Trigger compression of the local stack file.
@@ -312,9 +872,9 @@ class WorkflowItem():
         compression function should call back when complete to trigger
         the move to the next state.
         '''
-        self.awh.create_task(
+        self._schedule(
             compress_file(self.files['local_stack'], force=True),
-            done_cb=self._compressing_complete)
+            self._compressing_complete, LOW)
         self.files['local_compressed'] = self.files['local_stack'].with_suffix(
             self.files['local_stack'].suffix + '.bz2')
 
@@ -322,36 +882,45 @@ class WorkflowItem():
         self.export() if not fut.exception() else self.compress()
 
     def on_enter_exporting(self):
-        '''Export (copy) the compressed file to the storage location
+        '''Export (copy) the compressed file to the storage locations
+
+        The archive is read once and written to every export root at the same
+        time, each copy checked against the source digest. Destinations that
+        fail are retried on their own; the ones that succeeded are not
+        copied again. Packed items wait here for their container instead.
         '''
+        if self.packed:
+            self.project.pack(self)
+            return
         self.files['storage_final'] = pathlib.Path(
             self.project.paths['storage_root'],
             self.files['local_compressed'].name)
-        self.awh.create_task(
-            safe_copy_file(
-                self.files['local_compressed'],
-                self.files['storage_final']),
-            self._exporting_complete)
+        if self.export_pending is None:
+            self.export_pending = [
+                pathlib.Path(root, self.files['local_compressed'].name)
+                for root in self.project.paths['export_roots']]
+        self._schedule(
+            tee_copy_file(self.files['local_compressed'],
+                          self.export_pending),
+            self._exporting_complete, LOW)
 
     def _exporting_complete(self, fut):
         if fut.exception():
+            logger.warning('Export failed for {0}: {1}'.format(
+                self.files['local_compressed'], fut.exception()))
             self.awh.add_timed_callback(self.export, 10)
-        elif fut.result() == 0:
-            self.hold_for_processing()
-        else:
+            return
+        failed = []
+        for dest, error in fut.result().items():
+            if error is not None:
+                logger.warning('Export to {0} failed: {1}'.format(
+                    dest, error))
+                failed.append(pathlib.Path(dest))
+        self.export_pending = failed
+        if failed:
             self.awh.add_timed_callback(self.export, 10)
-
-    def on_enter_processing(self):
-        '''Maintain processing state until scipion processing is complete.
-
-        Watch for the indicators that the entire scipion processing stack has
-        completed. Until then, recurse back to this state entrance. Once it has
-        completed, proceed to clean up.
-        '''
-        if self._is_processing_complete(self.files['local_stack']):
-            self.confirm()
         else:
-            self.awh.add_timed_callback(self.hold_for_processing, 10)
+            self.confirm()
 
     def on_enter_confirming(self):
         '''Verify compression and that storage transfer is complete
@@ -359,31 +928,59 @@ class WorkflowItem():
         Confirm that:
         - The compression cycle is correct (hash original and re-uncompressed)
         - The transfer to storage is complete
+
+        The archive is decompressed to a separate verification file rather
+        than over the original, so the Scipion input is left untouched and
+        verification does not have to wait for Scipion processing. Files that
+        were archived uncompressed are hashed against the storage copy.
+        The verified digest is kept next to the storage copy (see
+        _digest_path). Packed items have already been verified as part of
+        their container, whose index records their digests.
         '''
-        new_name = self.files['local_original'].with_suffix('.orig')
-        self.files['local_uncompressed'] = self.files['local_original']
-        self.files['local_original'].rename(new_name)
-        self.files['local_original'] = pathlib.Path(new_name)
-        self.awh.create_task(
-            uncompress_file(self.files['local_compressed'], force=True),
-            self._uncompress_complete)
+        if self.packed:
+            self._confirm_complete(None)
+            return
+        if not self.compressed:
+            self._schedule(
+                compare_hashes(
+                    self.files['local_stack'],
+                    self.files['storage_final'],
+                    digest_file=self._digest_path()),
+                self._hashes_complete, LOW)
+            return
+        self.files['local_uncompressed'] = \
+            self.files['local_compressed'].with_suffix('.verify')
+        self._schedule(
+            uncompress_file(self.files['local_compressed'], force=True,
+                            dest=self.files['local_uncompressed']),
+            self._uncompress_complete, LOW)
+
+    def _digest_path(self):
+        '''Return the sidecar recording the archived data's tree_hash.
+        '''
+        storage = self.files['storage_final']
+        return storage.with_name(storage.name + DIGEST_SUFFIX)
 
     def _uncompress_complete(self, fut):
+        if fut.exception() or fut.result():
+            self.awh.add_timed_callback(self.confirm, 10)
+            return
         size_match = (os.stat(str(self.files['local_compressed'])).st_size ==
                       os.stat(str(self.files['storage_final'])).st_size)
         if size_match:
-            self.awh.create_task(
+            self._schedule(
                 compare_hashes(
-                    self.files['local_original'],
-                    self.files['local_uncompressed']),
-                self._hashes_complete)
+                    self.files['local_stack'],
+                    self.files['local_uncompressed'],
+                    digest_file=self._digest_path()),
+                self._hashes_complete, LOW)
         else:
-            pass
+            logger.warning('Size mismatch between {0} and {1}'.format(
+                self.files['local_compressed'], self.files['storage_final']))
 
     def _hashes_complete(self, fut):
         if fut.exception():
-            self.awh.add_timed_callback(
-                self._uncompress_complete, 10)
+            self.awh.add_timed_callback(self.confirm, 10)
             logger.warning(fut.exception())
         elif fut.result() is True:
             self._confirm_complete(fut)
@@ -391,19 +988,78 @@ class WorkflowItem():
             pass
 
     def _confirm_complete(self, fut):
-        self.clean()
+        '''Release the archival intermediates and wait for processing.
+        '''
+        if self.compressed:
+            self._safe_remove_file('local_compressed')
+            self._safe_remove_file('local_uncompressed')
+        self.hold_for_processing()
+
+    def on_enter_processing(self):
+        '''Hold the verified item until scipion processing is complete.
+
+        Processing is watched independently of the archival states by
+        _watch_processing, which triggers clean up if the item is already
+        waiting here.
+        '''
+        if self.processed:
+            self.clean()
+
+    def _watch_processing(self):
+        '''Poll for scipion processing completion alongside archival.
+
+        Watch for the indicators that the entire scipion processing stack has
+        completed. Until then, check back every 10 seconds. Safe to call more
+        than once; only the first call starts polling.
+        '''
+        if not self._watching_processing:
+            self._watching_processing = True
+            self._poll_processing()
+
+    def _poll_processing(self):
+        if self._is_processing_complete(self.files['local_stack']):
+            self.processed = True
+            if self.state == 'processing':
+                self.clean()
+        else:
+            self.awh.add_timed_callback(self._poll_processing, 10)
 
     def on_enter_cleaning(self):
+        self._safe_remove_file('local_view')
         self._safe_remove_file('local_stack')
         self._safe_remove_file('local_compressed')
         self._safe_remove_file('local_uncompressed')
         self._safe_remove_file('local_original')
         self._safe_remove_file('local_converted')
-        self._safe_remove_file('original')
-        if 'local_unstacked' in self.files:
-            [x.clean() for x in self.files['local_unstacked']]
+        self._remove_original()
+        if self.unstacked is not None:
+            [x.clean() for x in self.unstacked]
         self.finalize()
 
+    def _remove_original(self):
+        '''Remove the source file only if it is unchanged since import.
+
+        The archive was made from the imported copy, so a source that has
+        been modified or replaced since then is kept. A hardlinked import
+        shares its data with the source and cannot detect in-place changes
+        on its own, which is why the check is made against the source stat.
+        '''
+        if self.original_stat is None:
+            return
+        if self._stat_key(self.files['original']) != self.original_stat:
+            logger.warning('Not removing {0}, changed since import'
+                           .format(self.files['original']))
+            return
+        self._safe_remove_file('original')
+
+    @staticmethod
+    def _stat_key(path):
+        try:
+            stat = os.stat(str(path))
+        except OSError:
+            return None
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
     def _safe_remove_file(self, key):
         try:
             self._remove_file(self.files[key])
@@ -417,6 +1073,75 @@ class WorkflowItem():
             pass
 
     def on_enter_finished(self):
+        if self.volume is not None:
+            self.project.scratch.release(self.volume, self.reserved)
+        self.project.stats.record(self.size)
+        logger.info('Finalized: {0}'.format(self.files['original']))
+
+
+class ContainerItem(WorkflowItem):
+    '''A container packing the archives of several small items.
+
+    The container joins the workflow at compressing, where packing takes the
+    place of compression. It is exported like any other archive, then every
+    member is checked against the digest taken as it was packed. Once the
+    container is verified its members move on to wait for processing; the
+    container itself has no processing to wait for and is cleaned up.
+    '''
+    __slots__ = ('members', 'digests')
+
+    def __init__(self, path, workflow, project, members, size):
+        super().__init__(path, workflow, project)
+        self.members = members
+        self.digests = None
+        self.processed = True
+        self.compressed = False
+        self.files['local_compressed'] = self._place(size).joinpath(
+            self.files['original'].name)
+
+    def on_enter_compressing(self):
+        self._schedule(
+            pack_files(
+                [(member.files['local_stack'].name,
+                  member.files['local_stack'])
+                 for member in self.members],
+                self._partial_path(self.files['local_compressed'])),
+            self._compressing_complete, LOW)
+
+    def _compressing_complete(self, fut):
+        try:
+            index = fut.result()
+            self._hand_off(self.files['local_compressed'])
+        except Exception as e:
+            logger.warning('Packing failed for {0}: {1}'.format(
+                self.files['local_compressed'], e))
+            self.awh.add_timed_callback(self.compress, 10)
+            return
+        self.digests = {member['name']: member['digest'] for member in index}
+        logger.info('Packed {0} files into {1}'.format(
+            len(index), self.files['local_compressed']))
+        self.export()
+
+    def on_enter_confirming(self):
+        self._schedule(
+            verify_container(self.files['local_compressed'], self.digests),
+            self._verify_complete, LOW)
+
+    def _verify_complete(self, fut):
+        if fut.exception():
+            logger.warning(fut.exception())
+            self.awh.add_timed_callback(self.confirm, 10)
+        elif fut.result():
+            logger.error('{0} failed verification for {1}'.format(
+                self.files['local_compressed'], ', '.join(fut.result())))
+        else:
+            for member in self.members:
+                member.confirm()
+            self.hold_for_processing()
+
+    def on_enter_finished(self):
+        if self.volume is not None:
+            self.project.scratch.release(self.volume, self.reserved)
         logger.info('Finalized: {0}'.format(self.files['original']))
 
 
@@ -424,15 +1149,41 @@ class AsyncWorkflowHelper():
     '''Processes async calls for the workflow
     '''
 
-    def __init__(self):
+    def __init__(self, slots=6, low_share=0.25):
         self.loop = asyncio.get_event_loop()
+        self.owners = weakref.WeakKeyDictionary()
+        self.scheduler = StageScheduler(self.loop, slots=slots,
+                                        low_share=low_share,
+                                        owners=self.owners)
+
+    def schedule(self, coro, done_cb=None, priority=HIGH, key=0):
+        '''Queue a workflow stage coroutine by priority.
+
+        Unlike create_task, the coroutine does not start until the stage
+        scheduler has a free slot for it.
+        '''
+        self.scheduler.submit(coro, done_cb, priority, key)
 
     def create_task(self, coro, done_cb=None):
         task = self.loop.create_task(coro)
         task.add_done_callback(done_cb) if done_cb else None
+        self.owners[task] = self._owner_of(done_cb)
 
     def add_timed_callback(self, func, sleep):
-        self.loop.create_task(self._wrap_timed_callback(func, sleep))
+        task = self.loop.create_task(self._wrap_timed_callback(func, sleep))
+        self.owners[task] = self._owner_of(func)
+
+    @staticmethod
+    def _owner_of(func):
+        '''Return the object a callback belongs to, for task dumps.
+
+        Triggers added by transitions are partials bound to their model.
+        '''
+        owner = getattr(func, '__self__', None)
+        if owner is None and isinstance(func, functools.partial) and \
+                func.args:
+            owner = func.args[0]
+        return owner
 
     async def _wrap_timed_callback(self, func, sleep):
         await asyncio.sleep(sleep)